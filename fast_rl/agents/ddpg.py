@@ -3,7 +3,7 @@ import fastai.tabular.data
 from fastai.torch_core import *
 
 from fast_rl.agents.ddpg_models import DDPGModule
-from fast_rl.core.agent_core import ExperienceReplay, ExplorationStrategy, Experience
+from fast_rl.core.agent_core import ExperienceReplay, ExplorationStrategy, Experience, check_insert_order
 from fast_rl.core.basic_train import AgentLearner
 from fast_rl.core.data_block import MDPDataBunch, MDPStep, FEED_TYPE_STATE, FEED_TYPE_IMAGE
 
@@ -17,12 +17,14 @@ class DDPGLearner(AgentLearner):
         self.ddpg_trainers = listify(trainers)
         for t in self.ddpg_trainers: self.callbacks.append(t(self))
 
-    def predict(self, element, **kwargs):
+    def predict(self, element, model=None, **kwargs):
+        r""" Picks the actions of `element` with `model`, which defaults to `self.model`. """
+        model = ifnone(model, self.model)
         with torch.no_grad():
-            training = self.model.training
-            if element.shape[0] == 1: self.model.eval()
-            pred = self.model(element)
-            if training: self.model.train()
+            training = model.training
+            if element.shape[0] == 1: model.eval()
+            pred = model(element)
+            if training: model.train()
         return self.exploration_method.perturb(pred.detach().cpu().numpy(), self.data.action.action_space)
 
     def interpret_q(self, item):
@@ -51,7 +53,9 @@ class BaseDDPGTrainer(LearnerCallback):
 
     def on_loss_begin(self, **kwargs: Any):
         """Performs tree updates, exploration updates, and model optimization."""
-        if self.learn.model.training: self.learn.memory.update(item=self.learn.data.x.items[-1])
+        if self.learn.model.training:
+            # The dataset adds a step per env.
+            for item in self.learn.data.x.items[-self.learn.data.train_ds.n_envs:]: self.learn.memory.update(item=item)
         self.learn.exploration_method.update(self.episode, max_episodes=self.max_episodes, explore=self.learn.model.training)
         if not self.learn.warming_up:
             samples: List[MDPStep] = self.memory.sample(self.learn.data.bs)
@@ -67,6 +71,9 @@ def create_ddpg_model(data: MDPDataBunch, base_arch: DDPGModule, layers=None, ig
     bs, state, action = data.bs, data.state, data.action
     nc, w, h, n_conv_blocks = -1, -1, -1, [] if state.mode == FEED_TYPE_STATE else ifnone(channels, [32, 32, 32])
     if state.mode == FEED_TYPE_IMAGE: nc, w, h = state.s.shape[3], state.s.shape[2], state.s.shape[1]
+    # Channel first frames, such as from a `FramePipeline`, don't need to be transposed by the model.
+    if state.mode == FEED_TYPE_IMAGE and getattr(data.env, 'channel_first', False):
+        nc, w, h = state.s.shape[1], state.s.shape[2], state.s.shape[3]
     _layers = ifnone(layers, [400, 200] if len(n_conv_blocks) == 0 else [200, 200])
     if ignore_embed or np.any(state.n_possible_values == np.inf) or state.mode == FEED_TYPE_IMAGE: emb_szs = []
     else: emb_szs = [(d+1, int(fastai.tabular.data.emb_sz_rule(d))) for d in state.n_possible_values.reshape(-1, )]
@@ -84,4 +91,5 @@ ddpg_config = {
 def ddpg_learner(data: MDPDataBunch, model, memory: ExperienceReplay, exploration_method: ExplorationStrategy,
                 trainers=None, **kwargs):
     trainers = ifnone(trainers, ddpg_config[model.__class__])
+    check_insert_order(memory, data.train_ds.n_envs)
     return DDPGLearner(data, model, memory, exploration_method, trainers, **kwargs)
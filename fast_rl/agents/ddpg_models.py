@@ -1,5 +1,6 @@
 from fastai.callback import OptimWrapper
 
+from fast_rl.core.data_block import MDPBatch, as_model_input
 from fast_rl.core.layers import *
 
 
@@ -150,12 +151,14 @@ class DDPGModule(Module):
 
 		"""
 		with torch.no_grad():
-			r = torch.cat([item.reward.float() for item in sampled])
-			s_prime = torch.cat([item.s_prime for item in sampled])
-			s = torch.cat([item.s for item in sampled])
-			a = torch.cat([item.a.float() for item in sampled])
+			batch = MDPBatch.collate(sampled)
+			r = batch.reward.float()
+			s_prime = batch.s_prime
+			s = batch.s
+			a = batch.a.float()
+			discount = self.discount if batch.discount is None else batch.discount.float()
 
-		y = r + self.discount * self.t_critic_model((s_prime, self.t_action_model(s_prime)))
+		y = r + discount * self.t_critic_model((s_prime, self.t_action_model(s_prime)))
 
 		y_hat = self.critic_model((s, a))
 
@@ -197,4 +200,4 @@ class DDPGModule(Module):
 
 	def interpret_q(self, item):
 		with torch.no_grad():
-			return self.critic_model(torch.cat((item.s, item.a), 1))
\ No newline at end of file
+			return self.critic_model(torch.cat((as_model_input(item.s), item.a), 1))
\ No newline at end of file
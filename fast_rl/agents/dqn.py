@@ -2,9 +2,9 @@ from fastai.basic_train import LearnerCallback
 from fastai.tabular.data import emb_sz_rule
 
 from fast_rl.agents.dqn_models import *
-from fast_rl.core.agent_core import ExperienceReplay, ExplorationStrategy, Experience
+from fast_rl.core.agent_core import ExperienceReplay, ExplorationStrategy, Experience, check_insert_order
 from fast_rl.core.basic_train import AgentLearner
-from fast_rl.core.data_block import MDPDataBunch, FEED_TYPE_STATE, FEED_TYPE_IMAGE, MDPStep
+from fast_rl.core.data_block import MDPDataBunch, FEED_TYPE_STATE, FEED_TYPE_IMAGE, MDPStep, as_model_input
 
 
 class DQNLearner(AgentLearner):
@@ -16,16 +16,18 @@ class DQNLearner(AgentLearner):
         self.trainers = listify(trainers)
         for t in self.trainers: self.callbacks.append(t(self))
 
-    def predict(self, element, **kwargs):
-        training = self.model.training
-        if element.shape[0] == 1: self.model.eval()
-        pred = self.model(element)
-        if training: self.model.train()
+    def predict(self, element, model=None, **kwargs):
+        r""" Picks the actions of `element` with `model`, which defaults to `self.model`. """
+        model = ifnone(model, self.model)
+        training = model.training
+        if element.shape[0] == 1: model.eval()
+        pred = model(element)
+        if training: model.train()
         return self.exploration_method.perturb(torch.argmax(pred, 1), self.data.action.action_space)
 
     def interpret_q(self, item):
         with torch.no_grad():
-            return torch.sum(self.model(item.s)).cpu().numpy().item()
+            return torch.sum(self.model(as_model_input(item.s))).cpu().numpy().item()
 
 
 class FixedTargetDQNTrainer(LearnerCallback):
@@ -73,7 +75,9 @@ class BaseDQNTrainer(LearnerCallback):
 
     def on_loss_begin(self, **kwargs: Any):
         r"""Performs tree updates, exploration updates, and model optimization."""
-        if self.learn.model.training: self.learn.memory.update(item=self.learn.data.x.items[-1])
+        if self.learn.model.training:
+            # The dataset adds a step per env.
+            for item in self.learn.data.x.items[-self.learn.data.train_ds.n_envs:]: self.learn.memory.update(item=item)
         self.learn.exploration_method.update(self.episode, max_episodes=self.max_episodes, explore=self.learn.model.training)
         if not self.learn.warming_up:
             samples: List[MDPStep] = self.memory.sample(self.learn.data.bs)
@@ -87,6 +91,9 @@ def create_dqn_model(data: MDPDataBunch, base_arch: DQNModule, layers=None, igno
     bs,state,action=data.bs,data.state,data.action
     nc, w, h, n_conv_blocks = -1, -1, -1, [] if state.mode == FEED_TYPE_STATE else ifnone(channels, [16, 16, 16])
     if state.mode == FEED_TYPE_IMAGE: nc, w, h = state.s.shape[3], state.s.shape[2], state.s.shape[1]
+    # Channel first frames, such as from a `FramePipeline`, don't need to be transposed by the model.
+    if state.mode == FEED_TYPE_IMAGE and getattr(data.env, 'channel_first', False):
+        nc, w, h = state.s.shape[1], state.s.shape[2], state.s.shape[3]
     _layers = ifnone(layers, [64, 64])
     if ignore_embed or np.any(state.n_possible_values == np.inf) or state.mode == FEED_TYPE_IMAGE: emb_szs = []
     else: emb_szs = [(d+1, int(emb_sz_rule(d))) for d in state.n_possible_values.reshape(-1, )]
@@ -109,4 +116,5 @@ def dqn_learner(data: MDPDataBunch, model: DQNModule, memory: ExperienceReplay,
                 trainers=None, copy_over_frequency=300, **kwargs):
     trainers = ifnone(trainers, [c if c != FixedTargetDQNTrainer else partial(c, copy_over_frequency=copy_over_frequency)
                                  for c in dqn_config[model.__class__]])
+    check_insert_order(memory, data.train_ds.n_envs)
     return DQNLearner(data, model, memory, exploration_method, trainers, **kwargs)
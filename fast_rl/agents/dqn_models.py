@@ -1,5 +1,6 @@
 from fastai.callback import OptimWrapper
 
+from fast_rl.core.data_block import MDPBatch
 from fast_rl.core.layers import *
 
 
@@ -93,15 +94,16 @@ class DQNModule(Module):
 
 		"""
 		with torch.no_grad():
-			r = torch.cat([item.reward.float() for item in sampled])
-			s_prime = torch.cat([item.s_prime for item in sampled])
-			s = torch.cat([item.s for item in sampled])
-			a = torch.cat([item.a.long() for item in sampled])
-			d = torch.cat([item.done.float() for item in sampled])
-		masking = self.sample_mask(d)
+			batch = MDPBatch.collate(sampled)
+			r = batch.reward.float()
+			s_prime = batch.s_prime
+			s = batch.s
+			a = batch.a.long()
+			d = batch.done.float()
+		discount = self.discount * self.sample_mask(d) if batch.discount is None else batch.discount.float()
 
 		y_hat = self.y_hat(s, a)
-		y = self.y(s_prime, masking, r, y_hat)
+		y = self.y(s_prime, discount, r, y_hat)
 
 		loss = self.loss_func(y, y_hat)
 
@@ -121,8 +123,9 @@ class DQNModule(Module):
 	def y_hat(self, s, a):
 		return self.action_model(s).gather(1, a)
 
-	def y(self, s_prime, masking, r, y_hat):
-		return self.discount * self.action_model(s_prime).max(1)[0].unsqueeze(1) * masking + r.expand_as(y_hat)
+	def y(self, s_prime, discount, r, y_hat):
+		r""" `discount` is the discount of `s_prime` per sample, which is 0 for done samples. """
+		return self.action_model(s_prime).max(1)[0].unsqueeze(1) * discount + r.expand_as(y_hat)
 
 
 class FixedTargetDQNModule(DQNModule):
@@ -138,7 +141,7 @@ class FixedTargetDQNModule(DQNModule):
 		for target_param, local_param in zip(self.target_model.parameters(), self.action_model.parameters()):
 			target_param.data.copy_(self.tau * local_param.data + (1.0 - self.tau) * target_param.data)
 
-	def y(self, s_prime, masking, r, y_hat):
+	def y(self, s_prime, discount, r, y_hat):
 		r"""
 		Uses the equation:
 
@@ -148,7 +151,7 @@ class FixedTargetDQNModule(DQNModule):
 				\;|\; s, a \Big]
 
 		"""
-		return self.discount * self.target_model(s_prime).max(1)[0].unsqueeze(1) * masking + r.expand_as(y_hat)
+		return self.target_model(s_prime).max(1)[0].unsqueeze(1) * discount + r.expand_as(y_hat)
 
 
 class DoubleDQNModule(FixedTargetDQNModule):
@@ -156,9 +159,9 @@ class DoubleDQNModule(FixedTargetDQNModule):
 		super().__init__(ni, ao, layers, **kwargs)
 		self.name = 'DDQN'
 
-	def calc_y(self, s_prime, masking, r, y_hat):
-		return self.discount * self.target_model(s_prime).gather(1, self.action_model(s_prime).argmax(1).unsqueeze(
-			1)) * masking + r.expand_as(y_hat)
+	def calc_y(self, s_prime, discount, r, y_hat):
+		return self.target_model(s_prime).gather(1, self.action_model(s_prime).argmax(1).unsqueeze(
+			1)) * discount + r.expand_as(y_hat)
 
 
 class DuelingBlock(nn.Module):
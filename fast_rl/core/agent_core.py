@@ -1,11 +1,16 @@
+import threading
 from collections import deque
-from math import ceil
+from concurrent.futures import ThreadPoolExecutor
 
 import gym
 from fastai.basic_train import *
 from fastai.torch_core import *
 
-from fast_rl.core.data_structures import SumTree
+from fast_rl.core.data_block import MDPStep, MDPBatch
+from fast_rl.core.data_structures import SumTree, ArrayBuffer, MemMapBuffer, FrameBuffer, CompressedBuffer, \
+	NStepReturns, RankHeap, save_state, load_state, SequenceBuffer, \
+	HindsightBuffer
+from fast_rl.util.misc import is_goal_env, dict_obs_slices
 
 
 class ExplorationStrategy:
@@ -39,6 +44,11 @@ class GreedyEpsilon(ExplorationStrategy):
 		self.steps=0
 
 	def perturb(self, action, action_space: gym.Space):
+		if self.explore and len(action)>1:
+			# A batch of actions, one per env, so every env explores on its own.
+			action=action.clone()
+			for i in np.flatnonzero(np.random.random(len(action))<self.epsilon): action[i]=int(action_space.sample())
+			return action
 		return action_space.sample() if np.random.random()<self.epsilon and self.explore else action
 
 	def update(self, episode, end_episode=0, **kwargs):
@@ -70,26 +80,119 @@ class OrnsteinUhlenbeck(GreedyEpsilon):
 		self.x=np.ones(size)
 
 	def perturb(self, action, action_space):
+		# A batch of actions, one per env, gets a noise state per env, starting from the current one.
+		if self.x.ndim>1 and np.ndim(action)==self.x.ndim and len(action)!=len(self.x):
+			self.x=np.repeat(self.x[:1], len(action), axis=0)
 		dx=np.zeros(self.x.shape)
 		if self.explore:
-			dx=self.theta*(self.mu-self.x)+self.sigma*np.array([np.random.normal() for _ in range(len(self.x))])
+			noise=np.random.normal(size=len(self.x)).reshape((-1,)+(1,)*(self.x.ndim-1))
+			dx=self.theta*(self.mu-self.x)+self.sigma*noise
 
 		self.x+=dx
 		return self.epsilon*self.x+action
 
 
 class Experience:
-	def __init__(self, memory_size, reduce_ram=False):
+	# Storages that rely on consecutive inserts being consecutive steps of an episode.
+	_ordered_storages=('frames', 'sequences', 'hindsight')
+	_buffer_fn_dict={'objects': None, 'arrays': ArrayBuffer, 'memmap': MemMapBuffer, 'frames': FrameBuffer,
+					 'compressed': CompressedBuffer}
+	# Whether sampling uses the n-step rewards, which memories that sample their buffer in their own way do not.
+	_supports_n_step=True
+
+	def __init__(self, memory_size, reduce_ram=False, storage='objects', storage_kwargs=None, n_step=1, gamma=0.99):
+		r"""
+		Base for replay memories.
+
+		Args:
+			memory_size (int): Max N samples to store
+			reduce_ram (bool): Whether to `clean` the stored `MDPStep`s. Only used by the `objects` storage.
+			storage (str): How samples are stored. `objects` keeps a deep copy of every `MDPStep`. `arrays` writes the
+						   s, s_prime, a, reward, and done fields into preallocated columns, and samples `MDPBatch`s.
+						   `memmap` is the same as `arrays`, but keeps s and s_prime in a memory mapped file. `frames`
+						   is the same as `arrays`, but stores each observation once since s_prime of a step is s of
+						   the next step. `compressed` is the same as `arrays`, but zlib compresses every s and s_prime
+						   on its own, which is meant for image feeds. `SequenceExperienceReplay` and
+						   `HindsightExperienceReplay` add their own `sequences` and `hindsight` storages.
+			storage_kwargs (dict): Passed to the buffer of the chosen storage, such as the `path` of a `memmap` file.
+			n_step (int): Number of rewards to sum before bootstrapping. If more than 1, the discounted n-step rewards are
+						  kept up to date as samples are added, and sampled `MDPBatch`s hold the n-step reward, the
+						  bootstrap s_prime, and its `discount`. Needs a storage other than `objects`.
+			gamma (float): Discount of the n-step rewards. Should be the same as the `discount` of the model.
+		"""
+		if storage not in self._buffer_fn_dict: raise ValueError(f'Storage {storage} not in {list(self._buffer_fn_dict)}')
+		if n_step>1 and self._buffer_fn_dict[storage] is None: raise ValueError(f'n_step {n_step} needs a buffer storage')
+		if n_step>1 and not self._supports_n_step:
+			raise ValueError(f'{self.__class__.__name__} does not use n-step returns, so n_step has to be 1.')
 		self.reduce_ram=reduce_ram
 		self.max_size=memory_size
 		self.callbacks=[]
+		self.storage=storage
+		buffer_fn=self._buffer_fn_dict[storage]
+		self.buffer=None if buffer_fn is None else buffer_fn(memory_size, **ifnone(storage_kwargs, {}))
+		self.n_step_returns=NStepReturns(memory_size, n_step, gamma) if n_step>1 else None
 
 	@property
 	def memory(self): return None
+	@property
+	def needs_ordered_inserts(self): return self.storage in self._ordered_storages or self.n_step_returns is not None
 	def sample(self, **kwargs): pass
 	def update(self, item, **kwargs): item.to(device=defaults.device)
 	def refresh(self, **kwargs): pass
 
+	def to_fields(self, item: MDPStep):
+		r""" Converts a `MDPStep` into the numpy fields stored by `self.buffer`, dropping the batch dim. """
+		return {'s': item.s[0].detach().cpu().numpy(), 's_prime': item.s_prime[0].detach().cpu().numpy(),
+				'a': item.a[0].detach().cpu().numpy(), 'reward': item.reward[0].detach().cpu().numpy(),
+				'done': item.done[0].detach().cpu().numpy()}
+
+	def save(self, path):
+		r"""
+		Saves the memory into the directory `path` in a binary format instead of pickling it. The buffer columns,
+		tree priorities, and write cursors are saved as .npy files.
+
+		Only memories with a buffer storage can be saved, since the `objects` storage keeps python objects.
+		"""
+		if self.buffer is None: raise ValueError(f'Storage {self.storage} cannot be saved in binary, use a buffer.')
+		save_state(self, path)
+
+	@classmethod
+	def load(cls, path, mmap_mode='c'):
+		r""" Loads a memory saved by `save`, memory mapping its arrays. The saved files are not modified. """
+		return load_state(path, mmap_mode=mmap_mode)
+
+	def add_to_buffer(self, item: MDPStep):
+		r""" Writes `item` into `self.buffer`, returning its index. """
+		fields=self.to_fields(item)
+		idx=self.buffer.add(**fields)
+		if self.n_step_returns is not None: self.n_step_returns.add(idx, fields['reward'], fields['done'])
+		return idx
+
+	def gather(self, idx):
+		r""" Gathers the samples at `idx` from `self.buffer`, replacing their rewards with n-step rewards if needed. """
+		if self.n_step_returns is None: return self.buffer.get(idx)
+		fields=self.buffer.get(idx, keys=('s', 'a', 'done'))
+		fields['reward'], fields['discount'], bootstrap=self.n_step_returns.get(idx)
+		fields['s_prime']=self.buffer.get(bootstrap, keys=('s_prime',))['s_prime']
+		return fields
+
+	def to_batch(self, fields) -> MDPBatch:
+		r""" Converts fields gathered from `self.buffer` into a `MDPBatch` on the default device. """
+		batch=MDPBatch(**{k: torch.from_numpy(v) for k, v in fields.items()})
+		batch.to(device=defaults.device)
+		return batch
+
+
+def check_insert_order(memory: Experience, n_envs):
+	r"""
+	Vector envs insert their steps interleaved, so raises a `ValueError` if `memory` needs the steps of an episode to be
+	inserted in order, such as for n-step returns or the `frames` storage.
+	"""
+	if n_envs>1 and memory.needs_ordered_inserts:
+		raise ValueError(f'{memory.__class__.__name__} needs the steps of each episode inserted in order, but the '
+						 f'{n_envs} vector envs insert them interleaved. Use a single env, or a memory without n-step '
+						 f'returns or an order dependent storage.')
+
 
 class ExperienceReplay(Experience):
 	def __init__(self, memory_size, **kwargs):
@@ -109,22 +212,48 @@ class ExperienceReplay(Experience):
 
 	@property
 	def memory(self):
-		return self._memory
+		return self._memory if self.buffer is None else self.buffer
 
 	def __len__(self):
-		return len(self._memory)
+		return len(self._memory) if self.buffer is None else len(self.buffer)
 
 	def sample(self, batch, **kwargs):
+		if self.buffer is not None: return self.to_batch(self.gather(self.buffer.sample_idx(batch)))
 		if len(self._memory)<batch: return self._memory
 		return random.sample(self.memory, batch)
 
 	def update(self, item, **kwargs):
-		item=deepcopy(item)
+		if self.buffer is not None:
+			self.add_to_buffer(item)
+			return
+		# The cleaned copy shares the tensors of the step in the dataset.
+		item=item.copy()
 		super().update(item, **kwargs)
 		if self.reduce_ram: item.clean()
 		self._memory.append(item)
 
 
+class SequenceExperienceReplay(ExperienceReplay):
+	_buffer_fn_dict={**ExperienceReplay._buffer_fn_dict, 'sequences': SequenceBuffer}
+	_supports_n_step=False
+
+	def __init__(self, memory_size, seq_len=8, **kwargs):
+		r"""
+		Samples windows of `seq_len` consecutive steps from the same episode, for frame history and recurrent models.
+
+		Sampled `MDPBatch`s have fields of shape (bs, seq_len, ...), and a `mask` of shape (bs, seq_len) that is False
+		for the zero padded steps after the end of an episode.
+
+		Args:
+			memory_size (int): Max N samples to store
+			seq_len (int): Number of steps per window.
+		"""
+		super().__init__(memory_size, storage='sequences', storage_kwargs={'seq_len': seq_len}, **kwargs)
+
+	def sample(self, batch, **kwargs):
+		return self.to_batch(self.buffer.sample_windows(batch))
+
+
 class PriorityExperienceReplayCallback(LearnerCallback):
 	def on_train_begin(self, **kwargs):
 		self.learn.model.loss_func=partial(self.learn.model.memory.handle_loss, loss_fn=self.learn.model.loss_func)
@@ -154,43 +283,65 @@ class PriorityExperienceReplay(Experience):
 		self.beta=beta
 		self.b_inc=b_inc
 		self.p_weights=None  # np.zeros(self.batch_size, dtype=float)
+		# Sampling probabilities of the last sample, which `ShardedExperienceReplay` weights across its shards.
+		self.probabilities=None
 		self.epsilon=epsilon
-		self.tree=SumTree(self.max_size)
+		self.tree=self.make_tree()
 		self.callbacks=[PriorityExperienceReplayCallback]
 		# When sampled, store the sample indices for refresh.
 		self._indices=None  # np.zeros(self.batch_size, dtype=int)
 
 	@property
 	def memory(self):
-		return self.tree.data
+		return self.tree.data if self.buffer is None else self.buffer
 
 	def __len__(self):
 		return self.tree.n_entries
 
+	def make_tree(self):
+		r""" Makes the structure holding the priorities, which subclasses can replace. """
+		return SumTree(self.max_size)
+
 	def refresh(self, post_optimize, **kwargs):
 		if post_optimize is not None:
-			self.tree.update(self._indices.astype(int), np.abs(post_optimize['td_error'])+self.epsilon)
+			priorities=np.power(np.abs(post_optimize['td_error'])+self.epsilon, self.alpha)
+			self.tree.update(self._indices.astype(int), priorities)
+
+	def draw(self, batch):
+		r""" Draws `batch` samples from `self.tree`, returning their indices in the tree, priorities, and data. """
+		ranges=np.linspace(0, self.tree.total(), num=batch+1)
+		uniform_ranges=np.random.uniform(ranges[:-1], ranges[1:])
+		return self.tree.batch_get(uniform_ranges)
 
 	def sample(self, batch, **kwargs):
 		self.beta=np.min([1., self.beta+self.b_inc])
-		ranges=np.linspace(0, ceil(self.tree.total()/batch), num=batch+1)
-		uniform_ranges=[np.random.uniform(ranges[i], ranges[i+1]) for i in range(len(ranges)-1)]
-		try:
-			self._indices, weights, samples=self.tree.batch_get(uniform_ranges)
-		except ValueError:
+		self._indices, weights, samples=self.draw(batch)
+		if len(samples)==0:
 			warn('Too few values to unpack. Your batch size is too small, when PER queries tree, all 0 values get'
 				 ' ignored. We will retry until we can return at least one sample.')
 			samples=self.sample(batch)
 			return samples
 
+		if self.buffer is not None:
+			# With array storage, the tree data are the indices of the samples in the buffer. Buffers can drop samples
+			# early, so those are removed from the tree to never be sampled again, and the batch is redrawn.
+			valid=self.buffer.is_valid(samples.astype(int))
+			while not np.all(valid):
+				self.tree.remove(self._indices[~valid])
+				self._indices, weights, samples=self.draw(batch)
+				valid=self.buffer.is_valid(samples.astype(int))
+
 		self.p_weights=self.tree.anneal_weights(weights, self.beta)
+		self.probabilities=self.tree.probabilities(weights)
+		if self.buffer is not None: return self.to_batch(self.gather(samples.astype(int)))
 		return samples
 
 	def update(self, item, **kwargs):
 		"""
 		Updates the tree of PER.
 
-		Assigns maximal priority per [1] Alg:1, thus guaranteeing that sample being visited once.
+		Assigns maximal priority per [1] Alg:1, thus guaranteeing that sample being visited once. The first sample
+		gets a priority of 1.
 
 		Args:
 			item:
@@ -198,22 +349,250 @@ class PriorityExperienceReplay(Experience):
 		Returns:
 
 		"""
-		item=deepcopy(item)
+		maximal_priority=self.tree.max() if len(self)!=0 else 1.
+		if self.buffer is not None:
+			self.tree.add(maximal_priority, self.add_to_buffer(item))
+			return
+		# The cleaned copy shares the tensors of the step in the dataset.
+		item=item.copy()
 		super().update(item, **kwargs)
-		maximal_priority=self.alpha
 		if self.reduce_ram: item.clean()
-		self.tree.add(np.abs(maximal_priority)+self.epsilon, item)
-
-
-# class HindsightExperienceReplay(Experience):
-# 	def __init__(self, memory_size):
-# 		"""
-#
-# 		References:
-# 			[1] Andrychowicz, Marcin, et al. "Hindsight experience replay."
-# 			Advances in Neural Information Processing Systems. 2017.
-#
-# 		Args:
-# 			memory_size:
-# 		"""
-# 		super().__init__(memory_size)
+		self.tree.add(maximal_priority, item)
+
+
+class RankPriorityExperienceReplay(PriorityExperienceReplay):
+	def __init__(self, memory_size, alpha=0.7, beta=0.5, sort_every=None, n_partitions=100, **kwargs):
+		r"""
+		Rank based variant of `PriorityExperienceReplay`, which samples based on the rank of the priorities instead of
+		their magnitude, making it less sensitive to outliers.
+
+		References:
+			[1] Schaul, Tom, et al. "Prioritized experience replay." arXiv preprint arXiv:1511.05952 (2015).
+
+		Args:
+			memory_size (int): Max N samples to store
+			alpha (float): Changes the sampling behavior 1 (non-uniform) -> 0 (uniform)
+			sort_every (int): Number of priority updates between full sorts of the heap. Defaults to `memory_size`.
+			n_partitions (int): Number of memory sizes the sampling segments are computed for while filling up.
+		"""
+		self.sort_every, self.n_partitions=sort_every, n_partitions
+		super().__init__(memory_size, alpha=alpha, beta=beta, **kwargs)
+
+	def make_tree(self):
+		return RankHeap(self.max_size, self.alpha, sort_every=self.sort_every, n_partitions=self.n_partitions)
+
+	def draw(self, batch):
+		r""" Draws a sample per segment of the rank distribution, returning their indices, probabilities, and data. """
+		return self.tree.sample(batch)
+
+
+class ShardedExperienceReplay(Experience):
+	def __init__(self, memory_size, n_shards=4, memory_fn=ExperienceReplay, **kwargs):
+		r"""
+		Splits a replay memory into shards with their own locks, so that several producer threads can insert while
+		the learner samples.
+
+		Each producer thread inserts a whole episode into a shard, so a shard sees whole episodes in order, which
+		n-step returns and the `frames` storage rely on. After each of its episodes, a producer moves on to the next
+		shard with the fewest producers, so a single producer, such as the learner thread, fills the shards round robin.
+		Samples are drawn from the shards proportionally to their sizes, and concatenated. With PER shards, their IS
+		weights are recomputed over the whole memory by `anneal_weights`.
+
+		Only producer threads are supported. The shards and their locks live in this process, so a producer process
+		would insert into its own copy of the memory. Step environments in other processes with `EnvWorkers` instead,
+		and insert their steps from a thread of this one.
+
+		Args:
+			memory_size (int): Max N samples to store, split evenly over the shards.
+			n_shards (int): Number of shards. With more producer threads than shards, some episodes are interleaved.
+			memory_fn: Experience class of the shards, such as `PriorityExperienceReplay`.
+			**kwargs: Passed to `memory_fn`.
+		"""
+		super().__init__(memory_size)
+		self.shards=[memory_fn(memory_size//n_shards+int(i<memory_size%n_shards), **kwargs) for i in range(n_shards)]
+		self.p_weights=None
+		# The shard, and number of samples from it, of each part of the last sample.
+		self._sampled=None
+		self._init_locks()
+
+	def _init_locks(self):
+		self.locks=[threading.Lock() for _ in self.shards]
+		self.claim_lock=threading.Lock()
+		self._producers=threading.local()
+		self._n_producers=[0]*len(self.shards)
+
+	def __getstate__(self):
+		state=copy(self.__dict__)
+		state.update(locks=None, claim_lock=None, _producers=None, _n_producers=None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._init_locks()
+
+	def __len__(self):
+		return sum(len(shard) for shard in self.shards)
+
+	@property
+	def needs_ordered_inserts(self): return any(shard.needs_ordered_inserts for shard in self.shards)
+
+	def save(self, path):
+		r""" Saves the shards in binary like `Experience.save`, so they all need a buffer storage. """
+		for shard in self.shards:
+			if shard.buffer is None: raise ValueError(f'Storage {shard.storage} cannot be saved in binary, use a buffer.')
+		save_state(self, path, structures=(Experience,))
+
+	def _claim(self, previous=None):
+		r""" Moves the calling thread from shard `previous` to the next shard with the fewest producers. """
+		with self.claim_lock:
+			n=len(self.shards)
+			if previous is not None: self._n_producers[previous]-=1
+			start=0 if previous is None else previous+1
+			shard=min([(start+i)%n for i in range(n)], key=lambda i: self._n_producers[i])
+			self._n_producers[shard]+=1
+		return shard
+
+	def update(self, item, shard=None, **kwargs):
+		r""" Inserts `item` into `shard`, or the shard of the calling thread if None. """
+		if shard is not None:
+			with self.locks[shard]: self.shards[shard].update(item, **kwargs)
+			return
+		if getattr(self._producers, 'shard', None) is None: self._producers.shard=self._claim()
+		shard=self._producers.shard
+		with self.locks[shard]: self.shards[shard].update(item, **kwargs)
+		if item.d: self._producers.shard=self._claim(shard)
+
+	def sample(self, batch, **kwargs):
+		sizes=np.array([len(shard) for shard in self.shards], dtype=float)
+		if sizes.sum()==0: return []
+		samples, self._sampled=[], []
+		for i, n in enumerate(np.random.multinomial(batch, sizes/sizes.sum())):
+			if n==0: continue
+			with self.locks[i]:
+				samples.append(self.shards[i].sample(n, **kwargs))
+				probabilities=getattr(self.shards[i], 'probabilities', None)
+			self._sampled.append((i, len(samples[-1]), probabilities))
+
+		if all(probabilities is not None for _, _, probabilities in self._sampled):
+			self.p_weights=self.anneal_weights(sizes)
+		if all(isinstance(sample, MDPBatch) for sample in samples): return MDPBatch.cat(samples)
+		return [item for sample in samples for item in sample]
+
+	def anneal_weights(self, sizes):
+		r"""
+		IS weights of the last sample over the whole memory, rather than over the shard each sample came from.
+
+		A shard is drawn from with a probability of its share `N_i/N` of the memory, so a sample with a probability
+		`p` in its shard has a probability of `N_i/N*p` in the memory, and a weight of `(N_i*p)^-beta`. The weights are
+		normalized by the largest weight in the memory, from the smallest probability of any sampled shard. Each shard
+		only anneals its `beta` when it is sampled from, so the largest `beta` of the shards is used.
+		"""
+		shards=[i for i, shard in enumerate(self.shards) if sizes[i]!=0 and shard.probabilities is not None]
+		beta=max(self.shards[i].beta for i in shards)
+		min_probability=[]
+		for i in shards:
+			with self.locks[i]: min_probability.append(sizes[i]*self.shards[i].tree.min_probability())
+		weights=np.concatenate([np.power(sizes[i]*probabilities, -beta) for i, _, probabilities in self._sampled])
+		return (weights/np.power(min(min_probability), -beta)).astype(float)
+
+	def refresh(self, post_optimize, **kwargs):
+		r""" Hands each shard the part of `post_optimize` that belongs to the samples it returned. """
+		if post_optimize is None or self._sampled is None: return
+		start=0
+		for i, n, _ in self._sampled:
+			td_error=post_optimize['td_error'][start:start+n]
+			with self.locks[i]: self.shards[i].refresh(post_optimize={**post_optimize, 'td_error': td_error})
+			start+=n
+
+
+class PrefetchExperienceReplay(Experience):
+	_sample_state=('_indices', 'p_weights', '_sampled')
+
+	def __init__(self, memory: Experience):
+		r"""
+		Wraps a replay memory so that the next batch is sampled and collated on a worker thread while the current one
+		is being optimized.
+
+		Sampling a PER memory overwrites the indices that its `refresh` updates, so the sample state of each batch
+		(indices and IS weights) is kept with the batch and restored into the memory before its `refresh`. Since the
+		next batch is sampled before the current one is refreshed, it is drawn from priorities that are one
+		optimization step behind.
+
+		Args:
+			memory (Experience): The memory to sample from, such as a `PriorityExperienceReplay`.
+		"""
+		super().__init__(memory.max_size)
+		self.inner=memory
+		self.p_weights=None
+		self.lock=threading.Lock()
+		self.pool=ThreadPoolExecutor(1)
+		self._next=None
+		self._state=None
+
+	@property
+	def memory(self): return self.inner.memory
+	@property
+	def needs_ordered_inserts(self): return self.inner.needs_ordered_inserts
+
+	def __len__(self):
+		return len(self.inner)
+
+	def __getstate__(self):
+		state=copy(self.__dict__)
+		state.update(lock=None, pool=None, _next=None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.lock, self.pool=threading.Lock(), ThreadPoolExecutor(1)
+
+	def _sample(self, batch, **kwargs):
+		with self.lock:
+			sampled=self.inner.sample(batch, **kwargs)
+			state={k: getattr(self.inner, k) for k in self._sample_state if hasattr(self.inner, k)}
+		return (MDPBatch.collate(sampled) if len(sampled)!=0 else sampled), state
+
+	def update(self, item, **kwargs):
+		with self.lock: self.inner.update(item, **kwargs)
+
+	def sample(self, batch, **kwargs):
+		sampled, self._state=self._next.result() if self._next is not None else self._sample(batch, **kwargs)
+		self.p_weights=self._state.get('p_weights', None)
+		self._next=self.pool.submit(self._sample, batch, **kwargs)
+		return sampled
+
+	def refresh(self, **kwargs):
+		r""" Refreshes the inner memory with the sample state of the last returned batch. """
+		with self.lock:
+			for k, v in ifnone(self._state, {}).items(): setattr(self.inner, k, v)
+			self.inner.refresh(**kwargs)
+
+
+class HindsightExperienceReplay(ExperienceReplay):
+	_buffer_fn_dict={**ExperienceReplay._buffer_fn_dict, 'hindsight': HindsightBuffer}
+	_supports_n_step=False
+
+	def __init__(self, memory_size, env: gym.Env, k_future=4, **kwargs):
+		r"""
+		Relabels sampled batches with goals that were achieved later in the same episode, for GoalEnvs.
+
+		Observations of a GoalEnv are flattened by `State` in the order of its observation space, so the achieved
+		and desired goals are found with `dict_obs_slices`. See `HindsightBuffer` for how a batch is relabeled.
+
+		References:
+			[1] Andrychowicz, Marcin, et al. "Hindsight experience replay."
+			Advances in Neural Information Processing Systems. 2017.
+
+		Args:
+			memory_size (int): Max N samples to store
+			env (gym.Env): The GoalEnv, used for its observation space and `compute_reward`.
+			k_future (int): Number of relabeled samples per original sample.
+		"""
+		is_goal_env(env, suppress_errors=False)
+		slices=dict_obs_slices(env.observation_space)
+		storage_kwargs=dict(achieved_goal=slices['achieved_goal'], desired_goal=slices['desired_goal'],
+							compute_reward=env.unwrapped.compute_reward, k_future=k_future)
+		super().__init__(memory_size, storage='hindsight', storage_kwargs=storage_kwargs, **kwargs)
+
+	def sample(self, batch, **kwargs):
+		return self.to_batch(self.buffer.relabel(self.buffer.sample_idx(batch)))
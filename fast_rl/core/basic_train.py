@@ -1,9 +1,15 @@
-from multiprocessing.pool import Pool
+import random
+from collections import defaultdict
+from itertools import product
+from multiprocessing import get_context
+from queue import Empty
 
-from fastai.basic_train import Learner, load_callback
+from fastai.basic_train import Learner, LearnerCallback, DatasetType, load_callback
 from fastai.torch_core import *
 
+from fast_rl.core.agent_core import Experience
 from fast_rl.core.data_block import MDPDataBunch
+from fast_rl.core.train import AgentInterpretation, GroupAgentInterpretation
 
 
 class WrapperLossFunc(object):
@@ -20,6 +26,8 @@ def load_learner(path:PathOrStr, file:PathLikeOrBinaryStream='export.pkl', **db_
 	source = Path(path)/file if is_pathlike(file) else file
 	state = torch.load(source, map_location='cpu') if defaults.device == torch.device('cpu') else torch.load(source)
 	model = state.pop('model')
+	# A memory exported in binary is saved next to the export file.
+	if isinstance(state['memory'], Path): state['memory'] = Experience.load(Path(path)/state['memory'])
 	data = MDPDataBunch.load_state(path, state.pop('data'))
 	# if test is not None: src.add_test(test)
 	# data = src.databunch(**db_kwargs)
@@ -55,13 +63,21 @@ class AgentLearner(Learner):
 		 """
 		self.loss_func = WrapperLossFunc(self)
 
-	def export(self, file:PathLikeOrBinaryStream='export.pkl', destroy=False, pickle_data=False):
-		"Export the state of the `Learner` in `self.path/file`. `file` can be file-like (file or buffer)"
+	def export(self, file:PathLikeOrBinaryStream='export.pkl', destroy=False, pickle_data=False, memory_dir=None):
+		r"""
+		Export the state of the `Learner` in `self.path/file`. `file` can be file-like (file or buffer)
+
+		If `memory_dir` is not None, the memory is saved in binary to `self.path/memory_dir` instead of being
+		pickled, which is much faster for large buffers. `load_learner` then memory maps it back.
+		"""
 		if rank_distrib(): return # don't save if slave proc
 		# For now we exclude the 'loss_func' since it is pointing to a model loss.
 		args = ['opt_func', 'metrics', 'true_wd', 'bn_wd', 'wd', 'train_bn', 'model_dir', 'callback_fns', 'memory',
 				'exploration_method', 'trainers']
 		state = {a:getattr(self,a) for a in args}
+		if memory_dir is not None:
+			self.memory.save(Path(self.path)/memory_dir)
+			state['memory'] = Path(memory_dir)
 		state['cb_state'] = {cb.__class__:cb.get_state() for cb in self.callbacks}
 		#layer_groups -> need to find a way
 		#TO SEE: do we save model structure and weights separately?
@@ -80,12 +96,91 @@ class AgentLearner(Learner):
 		raise NotImplemented
 
 
-class PipeLine(object):
-	def __init__(self, n_threads, pipe_line_function):
-		warn(Warning('Currently not super useful. Seems to have issues with running a single env in multiple threads.'))
-		self.pipe_line_function = pipe_line_function
-		self.n_threads = n_threads
-		self.pool = Pool(self.n_threads)
+def _init_worker(n_threads):
+	# Without this every worker uses all of the cores for torch ops, and the runs fight over them.
+	torch.set_num_threads(n_threads)
+
+
+class RewardStream(LearnerCallback):
+	def __init__(self, learn, queue, key):
+		r"""
+		Puts the train reward of every epoch in `queue` as `(key, epoch, epoch_reward)`. It is summed over every step
+		of every env, so it is the reward of an episode only with a single env.
+		"""
+		super().__init__(learn)
+		self.queue,self.key,self.epoch_reward=queue,key,0.
+
+	def on_epoch_begin(self, **kwargs:Any): self.epoch_reward=0.
+
+	def on_batch_end(self, **kwargs:Any):
+		# The dataset adds a step per env.
+		if self.learn.model.training:
+			items=self.learn.data.x.items[-self.learn.data.train_ds.n_envs:]
+			self.epoch_reward+=sum(float(item.reward) for item in items)
 
-	def start(self, n_runs):
-		return self.pool.map(self.pipe_line_function,  range(n_runs))
\ No newline at end of file
+	def on_epoch_end(self, epoch, **kwargs:Any): self.queue.put((self.key, epoch, self.epoch_reward))
+
+
+def _run(learner_fn, name, config, seed, epochs, queue):
+	random.seed(seed)
+	np.random.seed(seed)
+	torch.manual_seed(seed)
+	learn=learner_fn(config, seed)
+	learn.callbacks.append(RewardStream(learn, queue, (name, seed)))
+	learn.fit(epochs)
+	interp=AgentInterpretation(learn, ds_type=DatasetType.Train)
+	interp.plot_rewards(cumulative=True, per_episode=True, group_name=name, no_show=True)
+	return interp.groups
+
+
+class ExperimentRunner(object):
+	def __init__(self, learner_fn:Callable[[Any, int], AgentLearner], n_workers=None, threads_per_worker=1):
+		r"""
+		Fits a learner for every config and seed across a pool of processes.
+
+		Workers are spawned instead of forked, so they do not inherit the envs or torch threads of this process.
+		Every run reports its epoch reward, see `RewardStream`, after each epoch while it is running, and its reward
+		groups are merged into a single `GroupAgentInterpretation` at the end.
+
+		Args:
+			learner_fn: Makes an unfitted learner from a config and a seed. Since it is sent to the workers, it needs
+						to be picklable, such as a module level function.
+			n_workers: Number of processes, by default as many as fit in the cpus with `threads_per_worker` each.
+			threads_per_worker: Torch intra-op threads of every worker.
+		"""
+		self.learner_fn=learner_fn
+		self.threads_per_worker=threads_per_worker
+		self.n_workers=ifnone(n_workers, max(1, defaults.cpus//threads_per_worker))
+		self.epoch_rewards=defaultdict(list)
+
+	def _drain(self, queue, on_reward):
+		while True:
+			try: (name, seed), epoch, epoch_reward=queue.get_nowait()
+			except Empty: return
+			self.epoch_rewards[(name, seed)].append(epoch_reward)
+			if on_reward is not None: on_reward(name, seed, epoch, epoch_reward)
+
+	def start(self, configs:Dict[str, Any], seeds:Collection[int], epochs:int,
+			  on_reward:Callable[[str, int, int, float], None]=None)->GroupAgentInterpretation:
+		r"""
+		Fits `epochs` epochs for every config in `configs` with every seed in `seeds`.
+
+		The epoch rewards are kept in `self.epoch_rewards` by (name, seed), and passed to `on_reward(name, seed,
+		epoch, epoch_reward)` in this process as they come in. The group names of the result are the keys of
+		`configs`.
+		"""
+		ctx=get_context('spawn')
+		self.epoch_rewards=defaultdict(list)
+		with ctx.Manager() as manager, ctx.Pool(self.n_workers, _init_worker, (self.threads_per_worker,)) as pool:
+			queue=manager.Queue()
+			results=[pool.apply_async(_run, (self.learner_fn, name, config, seed, epochs, queue))
+					 for (name, config), seed in product(configs.items(), seeds)]
+			for result in results:
+				while not result.ready():
+					result.wait(timeout=0.1)
+					self._drain(queue, on_reward)
+			self._drain(queue, on_reward)
+
+			group_interp=GroupAgentInterpretation()
+			for result in results: group_interp.groups+=result.get()
+		return group_interp
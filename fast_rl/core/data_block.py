@@ -10,6 +10,8 @@ from fastai.tabular.data import def_emb_sz
 from gym import Wrapper, Env
 from gym.spaces import Discrete, Box, MultiDiscrete
 import gc
+import heapq
+from bisect import bisect_left
 
 # from fast_rl.core.basic_train import AgentLearner
 from fast_rl.util.exceptions import MaxEpisodeStepsMissingError
@@ -142,9 +144,12 @@ from fastai.core import *
 from fastai.basic_data import *
 from fastai.imports import torch
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
 import pickle
 
-from fast_rl.util.misc import b_colors, list_in_str
+from fast_rl.util.misc import b_colors, list_in_str, flatten_dict_obs
+from fast_rl.core.data_structures import CompressedFrame
+from fast_rl.core.env_workers import EnvWorkers, repeat_step
 
 FEED_TYPE_IMAGE = 0
 FEED_TYPE_STATE = 1
@@ -159,6 +164,90 @@ class ResolutionWrapper(Wrapper):
         img = super(ResolutionWrapper,self).render(mode=mode,**kwargs)
         return img if len(img)==0 else img[::self.w_step,::self.h_step,:]
 
+
+# ITU-R 601 luma weights used for grayscale frames.
+_GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+class FramePipeline(Wrapper):
+    def __init__(self, env, crop=None, stride=None, resize=None, grayscale=False, channel_first=False, n_frames=1):
+        r"""
+        Preprocesses the rendered `rgb_array` frames once per step in numpy, so that `MDPStep` and the replay
+        memories get small uint8 frames instead of full resolution ones. Meant for `FEED_TYPE_IMAGE`, passed as the
+        `res_wrap` of `MDPDataBunch.from_env`.
+
+        The steps run in the order of the args: crop, stride, resize, grayscale, channel first layout, then stacking
+        the last `n_frames` frames on the channel axis.
+
+        Args:
+            env: Env to render.
+            crop: (top, bottom, left, right) bounds of the kept pixels, where None keeps that edge.
+            stride: (h_step, w_step) keeping every nth pixel, like `ResolutionWrapper`.
+            resize: (h, w) of a nearest neighbour resize.
+            grayscale: Whether the rgb channels are reduced to a single luma channel.
+            channel_first: Whether frames are (c, h, w). The models then skip their `ChannelTranspose`.
+            n_frames: Number of most recent frames stacked. They are kept in a circular buffer that is refilled
+                      with the first frame after a reset. Every step that is not rendered is missing from the stack.
+        """
+        super().__init__(env)
+        self.crop, self.stride, self.resize = crop, stride, resize
+        self.grayscale, self.channel_first, self.n_frames = grayscale, channel_first, n_frames
+        self._frames, self._pos, self._refill, self._new_step = None, 0, True, False
+        self._resize_idx, self._pooled = None, None
+
+    def reset(self, **kwargs):
+        self._refill, self._pooled = True, None
+        return self.env.reset(**kwargs)
+
+    def max_pool_next_render(self):
+        r"""
+        Keeps the raw frame of the current step, so that the next `rgb_array` render is the max of it and the frame of
+        that step. Used by `repeat_step`, so that the max is taken before processing and only one frame is stacked.
+        """
+        self._pooled = self.env.render(mode='rgb_array')
+
+    def step(self, action):
+        self._new_step = True
+        return self.env.step(action)
+
+    def _resize(self, frame):
+        h, w = frame.shape[:2]
+        # The indices only depend on the input size, so they are computed once.
+        if self._resize_idx is None or self._resize_idx[0] != (h, w):
+            rows = (np.arange(self.resize[0]) * h // self.resize[0])[:, None]
+            self._resize_idx = (h, w), rows, np.arange(self.resize[1]) * w // self.resize[1]
+        return frame[self._resize_idx[1], self._resize_idx[2]]
+
+    def process(self, frame):
+        r""" Runs every step except the stacking on a single (h, w, c) frame. """
+        if self.crop is not None:
+            top, bottom, left, right = self.crop
+            frame = frame[top:bottom, left:right]
+        if self.stride is not None: frame = frame[::self.stride[0], ::self.stride[1]]
+        if self.resize is not None: frame = self._resize(frame)
+        if self.grayscale: frame = (frame[..., :3] @ _GRAY_WEIGHTS)[..., None]
+        if self.channel_first: frame = frame.transpose(2, 0, 1)
+        return np.ascontiguousarray(frame, dtype=np.uint8)
+
+    def _stack(self, frame):
+        if self._refill or self._frames is None or self._frames.shape[1:] != frame.shape:
+            self._frames, self._pos = np.repeat(frame[None], self.n_frames, axis=0), 0
+        elif self._new_step: self._pos = (self._pos + 1) % self.n_frames
+        # Rendering the same step again replaces its frame instead of pushing another one.
+        self._frames[self._pos] = frame
+        self._refill, self._new_step = False, False
+
+        frames = self._frames[(self._pos + 1 + np.arange(self.n_frames)) % self.n_frames]
+        if self.channel_first: return frames.reshape((-1,) + frame.shape[1:])
+        return frames.transpose(1, 2, 0, 3).reshape(frame.shape[:2] + (-1,))
+
+    def render(self, mode='human', **kwargs):
+        img = self.env.render(mode=mode, **kwargs)
+        if mode != 'rgb_array' or img is None or len(img) == 0: return img
+        if self._pooled is not None: img, self._pooled = np.maximum(self._pooled, img), None
+        frame = self.process(img)
+        return frame if self.n_frames == 1 else self._stack(frame)
+
 @dataclass
 class Bounds(object):
     r"""
@@ -192,8 +281,11 @@ class Bounds(object):
 
         This is important for doing embeddings.
         """
-        if not self.discrete: return np.inf
-        else: return np.add(*np.abs((self.max, self.min))).reshape(1, -1)
+        # Computed once, since the bounds of a space are shared by all of its steps, see `space_meta`.
+        if getattr(self, '_n_possible_values', None) is None:
+            self._n_possible_values = np.inf if not self.discrete else \
+                np.add(*np.abs((self.max, self.min))).reshape(1, -1)
+        return self._n_possible_values
 
     def __post_init__(self):
         """Sets min and max fields then validates them."""
@@ -221,6 +313,92 @@ class Bounds(object):
         if len(self.min) == 0: raise ValueError(f'Min and Max are 0')
 
 
+class SpaceMeta(object):
+    def __init__(self, space: gym.Space):
+        r"""
+        Metadata of a gym space, which every `Action` and `State` of the space needs. Use `space_meta` to get the
+        cached one of a space instead of making a new one.
+
+        Args:
+            space: The space to describe.
+        """
+        self.space = space
+        self.bounds = Bounds(space)
+        # The functions converting `State` fields into tensors, by the type of the field.
+        self.converters: Dict[type, Callable] = {}
+
+    def converter(self, input_field) -> Callable:
+        r""" Returns the function converting fields of the type of `input_field`, picking it the first time. """
+        field_type = type(input_field)
+        if field_type not in self.converters: self.converters[field_type] = self._pick_converter(input_field)
+        return self.converters[field_type]
+
+    def _pick_converter(self, input_field):
+        if type(input_field) is str: return np.array
+        # GoalEnv observations are flattened in the order of the observation space, see `dict_obs_slices`.
+        elif isinstance(input_field, dict): return self._from_dict
+        elif type(input_field) is tuple: return self._from_tuple
+        elif np.isscalar(input_field): return torch.tensor
+        elif type(input_field) is torch.Tensor: return self._from_tensor
+        # Arrays are converted by `_as_tensor`, which only copies them if it needs to.
+        return _identity
+
+    def _from_dict(self, input_field): return torch.from_numpy(flatten_dict_obs(input_field, self.space))
+    def _from_tensor(self, input_field): return input_field.clone().detach()
+
+    def _from_tuple(self, input_field):
+        dtype = int if self.bounds.discrete else float
+        return torch.tensor(data=np.array(input_field).reshape(1, -1).astype(dtype))
+
+
+def _identity(input_field): return input_field
+
+
+_NP_DTYPES = {torch.uint8: np.dtype(np.uint8), torch.int64: np.dtype(np.int64), torch.float32: np.dtype(np.float32)}
+
+
+def _is_image(field):
+    is_uint8 = field.dtype == torch.uint8 if isinstance(field, torch.Tensor) else field.dtype == np.uint8
+    return is_uint8 and len(field.shape) >= 3
+
+
+def _as_tensor(field, dtype: torch.dtype) -> torch.Tensor:
+    r"""
+    Converts `field` into a tensor of `dtype`. Numpy arrays that already have `dtype`, are C contiguous, and are all
+    of the memory they point to are wrapped without copying. Others, such as strided views of a larger image, are
+    copied so that the tensor does not keep the whole base array alive.
+    """
+    if isinstance(field, torch.Tensor): return field.to(dtype)
+    np_dtype, base = _NP_DTYPES[dtype], field.base
+    owns_memory = base is None or getattr(base, 'nbytes', None) == field.nbytes
+    if field.dtype == np_dtype and field.flags.c_contiguous and owns_memory: return torch.from_numpy(field)
+    return torch.from_numpy(np.array(field, dtype=np_dtype, order='C'))
+
+
+def as_model_input(x: torch.Tensor) -> torch.Tensor:
+    r""" Images are kept as uint8 until they are given to a model, which needs them as floats. """
+    return x.float() if x.dtype == torch.uint8 else x
+
+
+# The `SpaceMeta` of every space seen so far by id. The space is kept with it so that its id is never reused.
+_SPACE_META: Dict[int, Tuple[gym.Space, SpaceMeta]] = {}
+# The observation spaces of image states by shape.
+_IMAGE_SPACES: Dict[tuple, gym.Space] = {}
+
+
+def space_meta(space: gym.Space) -> SpaceMeta:
+    r""" Returns the `SpaceMeta` of `space`, which is only computed the first time. """
+    cached = _SPACE_META.get(id(space))
+    if cached is None or cached[0] is not space: cached = _SPACE_META[id(space)] = (space, SpaceMeta(space))
+    return cached[1]
+
+
+def image_space(shape) -> gym.Space:
+    r""" Returns the observation space of images with `shape`, which is only made the first time. """
+    if shape not in _IMAGE_SPACES: _IMAGE_SPACES[shape] = gym.spaces.Box(0, 255, shape, dtype=np.int64)
+    return _IMAGE_SPACES[shape]
+
+
 @dataclass
 class Action(object):
     r"""
@@ -255,7 +433,7 @@ class Action(object):
 
     def __post_init__(self):
         # Determine bounds
-        self.bounds = Bounds(self.action_space)
+        self.bounds = space_meta(self.action_space).bounds
 
         # Fix shapes
         if not isinstance(self.taken_action, torch.Tensor):
@@ -328,19 +506,15 @@ class State(object):
 
         return f'State: ' + ', '.join([str(i) for i in out.items()])
 
-    def _fix_field(self, input_field):
+    def _fix_field(self, input_field, meta: SpaceMeta):
         if input_field is None: return None
-        input_field = copy(input_field)
-
-        if type(input_field) is str: input_field = np.array(input_field)
-        elif type(input_field) is tuple:
-            dtype = int if self.bounds.discrete else float
-            input_field = torch.tensor(data=np.array(input_field).reshape(1, -1).astype(dtype))
-        elif np.isscalar(input_field): input_field = torch.tensor(data=input_field)
-        elif type(input_field) is torch.Tensor: input_field = input_field.clone().detach()
-        else: input_field = torch.from_numpy(input_field)
+        # Envs return new arrays every step, so they are not copied. Tensors might still be used elsewhere.
+        input_field = meta.converter(input_field)(input_field)
 
-        input_field = input_field.long() if self.bounds.discrete and self.mode != FEED_TYPE_IMAGE else input_field.float()
+        if _is_image(input_field): dtype = torch.uint8
+        elif self.bounds.discrete and self.mode != FEED_TYPE_IMAGE: dtype = torch.int64
+        else: dtype = torch.float32
+        input_field = _as_tensor(input_field, dtype)
         # If a non-image state missing the batch dim
         if len(input_field.shape) <= 1: return input_field.reshape(1, -1)
         # If a non-image 2+d state missing the batch dim
@@ -358,20 +532,35 @@ class State(object):
             ValueError(f'Mode invalid {self.mode} not valid feed type')
         # We want to swap the state variables if the alt is the image state
         if self.mode == FEED_TYPE_IMAGE and len(self.alt_s.shape) > 2 and len(self.s.shape) != 3:
-            self.observation_space = gym.spaces.Box(0, 255, self.alt_s.shape, dtype=np.int64)
+            self.observation_space = image_space(self.alt_s.shape)
             self.alt_s, self.alt_s_prime, self.s, self.s_prime = self.s, self.s_prime, self.alt_s, self.alt_s_prime
         # Determine bounds
-        self.bounds = Bounds(self.observation_space)
+        meta = space_meta(self.observation_space)
+        self.bounds = meta.bounds
         # Fix Shapes
-        self.s, self.s_prime = self._fix_field(self.s), self._fix_field(self.s_prime)
-        self.alt_s, self.alt_s_prime = self._fix_field(self.alt_s), self._fix_field(self.alt_s_prime)
+        self.s, self.s_prime = self._fix_field(self.s, meta), self._fix_field(self.s_prime, meta)
+        self.alt_s, self.alt_s_prime = self._fix_field(self.alt_s, meta), self._fix_field(self.alt_s_prime, meta)
+
+
+def _decompress(field):
+    return torch.from_numpy(field.numpy()) if isinstance(field, CompressedFrame) else field
+
+
+def _view(cls, **fields):
+    r""" Makes a `cls` from fields that are already fixed, skipping its `__post_init__`. """
+    view = cls.__new__(cls)
+    view.__dict__.update(fields)
+    return view
 
 
-@dataclass
 class MDPStep(object):
     r"""
     Contains all the variables to represent a Markov Decision Process step.
 
+    Only the tensors and scalars of the `Action` and `State` it is made from are kept, with references to their
+    spaces and bounds that every step shares. `action`, `state`, and `obj` build views of them on demand for
+    interpretation code, so changing a view does not change the step.
+
     action (Action):
 
     state (State):
@@ -385,52 +574,116 @@ class MDPStep(object):
     step (int):
 
     """
-    action: Action
-    state: State
-    done: torch.tensor
-    reward: torch.tensor
-    episode: int
-    step: int
-
-    def __post_init__(self):
-        self.action = deepcopy(self.action)
-        self.state = deepcopy(self.state)
-        self.reward = torch.tensor(data=self.reward).reshape(1, -1).float()
-        self.done = torch.tensor(data=self.done).reshape(1, -1).float()
+    __slots__ = ('a', 'raw_action', 'action_space', 'action_bounds', '_s', '_s_prime', '_alt_s', '_alt_s_prime',
+                 'observation_space', 'state_bounds', 'mode', 'done', 'reward', 'episode', 'step')
+
+    def __init__(self, action: Action, state: State, done, reward, episode: int, step: int):
+        self.a, self.raw_action = action.taken_action, action.raw_action
+        self.action_space, self.action_bounds = action.action_space, action.bounds
+        # The state tensors can be shared with neighboring steps. They are never modified inplace.
+        self._s, self._s_prime, self._alt_s, self._alt_s_prime = state.s, state.s_prime, state.alt_s, state.alt_s_prime
+        self.observation_space, self.state_bounds, self.mode = state.observation_space, state.bounds, state.mode
+        self.reward = torch.tensor(data=reward).reshape(1, -1).float()
+        self.done = torch.tensor(data=done).reshape(1, -1).float()
+        self.episode, self.step = episode, step
+
+    def copy(self):
+        r""" Shallow copy, sharing the tensors of this step. """
+        item = MDPStep.__new__(MDPStep)
+        for k in self.__slots__: setattr(item, k, getattr(self, k))
+        return item
+
+    __copy__ = copy
 
     def to(self, device):
-        self.reward = self.reward.to(device=device)
-        self.done = self.done.to(device=device)
-        self.action.to(device=device)
-        self.state.to(device=device)
+        for k in ('a', 'raw_action', '_s', '_s_prime', 'reward', 'done'):
+            v = getattr(self, k)
+            if isinstance(v, torch.Tensor): setattr(self, k, v.to(device=device))
 
     def clean(self):
         r""" Removes fields that are generally unimportant (purely debugging) """
-        self.state.alt_s_prime = None
-        self.state.alt_s = None
-        self.state.observation_space = None
-        self.state.bounds = None
-        self.action.raw_action = None
-        self.action.action_space = None
-        self.action.bounds = None
-
-    def __str__(self): return ', '.join([str(self.__dict__[el]) for el in self.__dict__])
+        self._alt_s_prime, self._alt_s = None, None
+        self.observation_space, self.state_bounds = None, None
+        self.raw_action, self.action_space, self.action_bounds = None, None, None
+
+    def __str__(self): return ', '.join([str(v) for v in self.obj.values()])
     @property
-    def data(self): return self.s_prime[0], self.alt_s_prime[0] if self.alt_s_prime is not None else None
+    def action(self) -> Action:
+        return _view(Action, taken_action=self.a, action_space=self.action_space, raw_action=self.raw_action,
+                     bounds=self.action_bounds)
+    @property
+    def state(self) -> State:
+        return _view(State, s=self._s, s_prime=self._s_prime, alt_s=self._alt_s, alt_s_prime=self._alt_s_prime,
+                     observation_space=self.observation_space, mode=self.mode, bounds=self.state_bounds)
     @property
-    def obj(self): return self.__dict__
+    def data(self): return self.s_prime[0], self.alt_s_prime[0] if self.alt_s_prime is not None else None
     @property
-    def s(self): return self.state.s
+    def obj(self):
+        return {'action': self.action, 'state': self.state, 'done': self.done, 'reward': self.reward,
+                'episode': self.episode, 'step': self.step}
     @property
-    def s_prime(self): return self.state.s_prime
+    def s(self): return _decompress(self._s)
     @property
-    def alt_s_prime(self): return self.state.alt_s_prime
+    def s_prime(self): return _decompress(self._s_prime)
     @property
-    def a(self): return self.action.taken_action
+    def alt_s_prime(self): return _decompress(self._alt_s_prime)
     @property
     def d(self): return bool(self.done)
 
 
+@dataclass
+class MDPBatch(object):
+    r"""
+    Contains the fields of many `MDPStep`s stacked along the batch dimension, ready for a model's `optimize`.
+
+    s (torch.tensor): States with shape (bs, ...).
+
+    s_prime (torch.tensor): Next states with shape (bs, ...).
+
+    a (torch.tensor): Taken actions with shape (bs, -1).
+
+    reward (torch.tensor): Rewards with shape (bs, 1).
+
+    done (torch.tensor): Dones with shape (bs, 1).
+
+    discount (torch.tensor): Discounts of s_prime with shape (bs, 1), already 0 for done samples. Only set by n-step
+    replay, where `reward` is the discounted sum of n rewards and `s_prime` is the state n steps later.
+
+    mask (torch.tensor): Only set by sequence replay, where the fields have shape (bs, seq_len, ...). Is False for
+    padded steps with shape (bs, seq_len).
+    """
+    s: torch.tensor
+    s_prime: torch.tensor
+    a: torch.tensor
+    reward: torch.tensor
+    done: torch.tensor
+    discount: torch.tensor = None
+    mask: torch.tensor = None
+
+    def __post_init__(self):
+        self.s, self.s_prime = as_model_input(self.s), as_model_input(self.s_prime)
+
+    def __len__(self): return self.s.shape[0]
+
+    def to(self, device):
+        for k, v in self.__dict__.items():
+            if isinstance(v, torch.Tensor): setattr(self, k, v.to(device=device))
+
+    @classmethod
+    def collate(cls, sampled: Union['MDPBatch', List[MDPStep]]) -> 'MDPBatch':
+        r""" Stacks a list of `MDPStep`s. If `sampled` is already a `MDPBatch`, then it is returned as is. """
+        if isinstance(sampled, MDPBatch): return sampled
+        return cls(s=torch.cat([item.s for item in sampled]), s_prime=torch.cat([item.s_prime for item in sampled]),
+                   a=torch.cat([item.a for item in sampled]), reward=torch.cat([item.reward for item in sampled]),
+                   done=torch.cat([item.done for item in sampled]))
+
+    @classmethod
+    def cat(cls, batches: List['MDPBatch']) -> 'MDPBatch':
+        r""" Concatenates `MDPBatch`s along the batch dimension. """
+        return cls(**{k: None if v is None else torch.cat([getattr(batch, k) for batch in batches])
+                      for k, v in batches[0].__dict__.items()})
+
+
 class MDPCallback(LearnerCallback):
     _order = -11  # Needs to happen before Recorder
     def on_backward_end(self, **kwargs: Any): return {'skip_step': True}
@@ -447,20 +700,50 @@ class MDPCallback(LearnerCallback):
         self.keep_env_open=keep_env_open
         self.train_ds: MDPDataset = learn.data.train_ds
         self.valid_ds: MDPDataset = None if learn.data.empty_val else learn.data.valid_ds
+        # The copy of the model that picks actions on the step thread when a dataset has a `policy_lag`.
+        self._acting_model = None
+
+    def _act(self, ds, last_input, model=None):
+        a = self.learn.predict(as_model_input(last_input), model=model)
+        ds.action = Action(taken_action=a, action_space=self.train_ds.action.action_space)
+
+    def acting_model(self):
+        r"""
+        Returns a copy of the model with its current weights, which the step thread predicts with while the model
+        itself is being optimized. Attributes that are not modules or tensors, such as the optimizer, are shared.
+        """
+        model = self.learn.model
+        if self._acting_model is None:
+            shared = {id(v): v for k, v in vars(model).items()
+                      if not k.startswith('_') and not isinstance(v, (nn.Module, torch.Tensor))}
+            self._acting_model = deepcopy(model, shared)
+        self._acting_model.load_state_dict(model.state_dict())
+        self._acting_model.train(model.training)
+        return self._acting_model
 
     def on_batch_begin(self, last_input, last_target, train, **kwargs: Any):
         r""" Set the Action of a dataset, determine if still warming up. """
-        a = self.learn.predict(last_input)
-        if self.learn.model.training:
-            self.train_ds.action = Action(taken_action=a, action_space=self.train_ds.action.action_space)
-        else: self.valid_ds.action = Action(taken_action=a, action_space=self.train_ds.action.action_space)
+        # In vector mode, the single item of a batch holds the states of every env.
+        if self.train_ds.n_envs != 1: last_input = last_input[0]
+        ds = self.train_ds if self.learn.model.training else self.valid_ds
+        lagged = ds.async_step and ds.policy_lag != 0
+        if not lagged: self._act(ds, last_input)
         self.train_ds.is_warming_up = self.learn.warming_up
         if self.valid_ds is not None: self.valid_ds.is_warming_up = self.learn.warming_up
         if not self.learn.warming_up and self.learn.loss_func is None: self.learn.init_loss_func()
+        if lagged: ds.step_async(partial(self._act, ds, last_input, self.acting_model()))
+        elif ds.async_step: ds.step_async()
         return {'skip_bwd': True, 'train': not self.train_ds.is_warming_up and train}
 
+    def on_batch_end(self, **kwargs: Any):
+        r""" Waits for an async env step, so that it only ever overlaps with the optimization of its batch. """
+        for ds in [self.train_ds, self.valid_ds]:
+            if ds is not None: ds.wait_step()
+
     def on_epoch_end(self, last_metrics, epoch, **kwargs: Any) -> None:
         r""" Updates the most recent episode number in both datasets. """
+        # In vector mode, episodes are numbered as they start instead.
+        if self.train_ds.n_envs != 1: return
         relative_epoch = sorted(self.train_ds.x.info.keys())[-1] + 1 if self.train_ds.x.info else epoch
         self.train_ds.episode = relative_epoch
         self.train_ds.x.set_recent_run_episode(self.train_ds.episode)
@@ -543,37 +826,84 @@ class MDPMemoryManager(LearnerCallback):
 
 
 class MDPDataset(Dataset):
-    def __init__(self, env: gym.Env, memory_manager, bs, render='rgb_array', feed_type=FEED_TYPE_STATE, max_steps=None,
-                 x=None, keep_env_open=True):
+    def __init__(self, env: Union[gym.Env, List[gym.Env], EnvWorkers], memory_manager, bs, render='rgb_array',
+                 feed_type=FEED_TYPE_STATE, max_steps=None, x=None, keep_env_open=True, compress_frames=False,
+                 async_step=False, render_policy='always', k=1, frame_skip=1, policy_lag=0):
         r"""
         Handles env execution and ItemList building.
 
+        If `env` is a list of envs, they are stepped in lockstep, and every item of the dataset holds the stacked
+        s_prime of all of them, so the model predicts the actions of every env at once. Each env resets on its own
+        when its episode is done, and episodes are numbered as they start. An epoch is then `max_steps` steps of
+        every env instead of a single episode. The steps of the envs are interleaved in `x`, so replay memories
+        that rely on the consecutive steps of an episode (n-step returns, `frames`, `sequences`, `hindsight`) raise
+        a `ValueError` when given to a learner, see `check_insert_order`.
+
+        `env` can also be an `EnvWorkers`, in which case the envs are stepped in parallel in their own processes.
+
         Args:
-            env: OpenAI environment to execute.
+            env: OpenAI environment to execute, a list of copies of it, or `EnvWorkers` running the copies.
             memory_manager: Handles how the list size will be reduced sch as removing image data.
             bs: Size of a single batch for models and the dataset to use.
+            compress_frames: Whether `self.x` zlib compresses the images of steps that are no longer the current one.
+            async_step: Whether the next env step runs on a background thread while the model optimizes. See
+                        `step_async`.
+            policy_lag: With `async_step`, 0 picks the action of the next step before the model optimizes. 1 also
+                        picks it on the background thread, with a copy of the weights from before the update, so
+                        that predicting overlaps with the optimization as well.
+            render_policy: Which steps are rendered into `alt_s`/`alt_s_prime`, the others are None:
+                           'always', 'never', an int `n` for every `n` steps of an episode, or 'k_top'. Under
+                           'k_top' an episode stops rendering once its reward so far, plus the most it can get in its
+                           remaining steps, cannot reach the `k` best episodes so far, since a 'k_top' memory manager
+                           will not keep it. The most reward per step is the top of `env.reward_range`, so envs with
+                           an unbounded range render every step. Image feeds are always rendered.
+            k: Number of episodes the memory manager keeps, used by the 'k_top' render policy.
+            frame_skip: Number of times each chosen action is repeated, summing the rewards. A single `MDPStep` is
+                        made per action, and image feeds get the max of the last two frames. `EnvWorkers` repeat
+                        actions themselves, using their own `frame_skip`.
         """
-        for wrapper_fn in WRAP_ENV_FNS: env = wrapper_fn(env, render)
-        self.env = env
+        self.workers = env if isinstance(env, EnvWorkers) else None
+        if self.workers is None:
+            self.envs = listify(env)
+            for wrapper_fn in WRAP_ENV_FNS: self.envs = [wrapper_fn(e, render) for e in self.envs]
+            self.env, self.n_envs = self.envs[0], len(self.envs)
+        else:
+            # The workers own their envs, which `make_env` already wrapped.
+            self.envs, self.env, self.n_envs = [], self.workers.env, self.workers.n_envs
         self.render = render
         self.feed_type = feed_type
         self.bs = bs
         self._max_steps = max_steps
-        self.action = Action(taken_action=self.env.action_space.sample(), action_space=self.env.action_space)
+        self.action = Action(taken_action=np.stack([self.env.action_space.sample() for _ in range(self.n_envs)]),
+                             action_space=self.env.action_space)
         self.state = None
         self.s_prime, self.alt_s_prime = None, None
+        # The last step, next state, and step count of each env in vector mode.
+        self.items: List[Union[MDPStep, None]] = [None] * self.n_envs
+        self.s_primes, self.alt_s_primes = [None] * self.n_envs, [None] * self.n_envs
+        self.counters = [0] * self.n_envs
         self.callback = [partial(MDPCallback, keep_env_open=keep_env_open), memory_manager]
         # Tracking fields
         self.episode = -1 if x is None else max([i.episode + 1 for i in x.items])
+        if self.n_envs != 1: self.episode = max(self.episode, 0)
         self.counter = 0
         # While true, the dataset object with loop until the the number of loops is more than the batch size.
         # This allows a model to fill its buffers before doing proper epoch iterating.
         self.is_warming_up = True
+        if policy_lag not in (0, 1): raise ValueError(f'policy_lag has to be 0 or 1, not {policy_lag}')
+        self.async_step, self.policy_lag = async_step, policy_lag
+        self._executor, self._next = None, None
+        self.render_policy, self.k = render_policy, k
+        self.frame_skip = frame_skip if self.workers is None else self.workers.frame_skip
+        # Under 'k_top', the reward of the current episode of each env, and a min heap of the k best episode rewards.
+        self._running_rewards, self._top_rewards = [0.] * self.n_envs, []
 
         # FastAI fields
         self.x = ifnone(x, MDPList([]))
+        self.x.compress_frames = compress_frames
         self.item: Union[MDPStep, None] = None
-        self.new(None)
+        if self.n_envs == 1: self.new(None)
+        else: self.new_vector()
 
     def get_emb_szs(self): return [def_emb_sz(0, 0,None)]
 
@@ -583,7 +913,9 @@ class MDPDataset(Dataset):
 
     def get_state(self, **extra):
         return {'env_name': self.env_name, 'max_steps': self.max_steps, 'render': self.render, 'bs': self.bs,
-                'feed_type': self.feed_type}
+                'feed_type': self.feed_type, 'compress_frames': self.x.compress_frames, 'n_envs': self.n_envs,
+                'env_workers': self.workers is not None, 'async_step': self.async_step, 'policy_lag': self.policy_lag,
+                'render_policy': self.render_policy, 'frame_skip': self.frame_skip}
 
     @property
     def env_name(self): return self.env.spec.id
@@ -601,20 +933,51 @@ class MDPDataset(Dataset):
         raise MaxEpisodeStepsMissingError(msg)
 
     @property
-    def image(self):
+    def image(self): return self.env_image(self.env)
+
+    def env_image(self, env):
         r""" Needed because of blackjack-v0 env >:( """
         try:
-            current_image = self.env.render('rgb_array')
-            if self.render == 'human': self.env.render(self.render)
+            current_image = env.render('rgb_array')
+            if self.render == 'human': env.render(self.render)
         except NotImplementedError:
-            print(f'{b_colors.WARNING} {self.env.unwrapped.spec} Not returning Image {b_colors.ENDC}')
+            print(f'{b_colors.WARNING} {env.unwrapped.spec} Not returning Image {b_colors.ENDC}')
             current_image = None
         return current_image
 
+    def _needs_image(self, i, step):
+        r""" Whether env `i` renders the image of `step` of its current episode under `self.render_policy`. """
+        if self.feed_type == FEED_TYPE_IMAGE or self.render_policy == 'always': return True
+        if self.render_policy == 'never': return False
+        if self.render_policy == 'k_top': return self._can_be_top(i, step)
+        return step % self.render_policy == 0
+
+    def _can_be_top(self, i, step):
+        r""" Whether the episode of env `i` can still reach the `k` best episodes from `step` on. """
+        max_reward = self.env.reward_range[1]
+        if len(self._top_rewards) < self.k or not np.isfinite(max_reward): return True
+        # `step` is the one about to be taken, and each of them can repeat its action `frame_skip` times.
+        best_remaining = max_reward * self.frame_skip * max(self.max_steps - step + 1, 0)
+        return self._running_rewards[i] + best_remaining >= self._top_rewards[0]
+
+    def _track_reward(self, i, item: MDPStep):
+        if self.render_policy != 'k_top': return
+        self._running_rewards[i] += float(item.reward)
+        if not item.d: return
+        if len(self._top_rewards) < self.k: heapq.heappush(self._top_rewards, self._running_rewards[i])
+        else: heapq.heappushpop(self._top_rewards, self._running_rewards[i])
+        self._running_rewards[i] = 0.
+
     # Needs to be explicitly closed
     # def __del__(self):
     #     self.env.close()
 
+    def close(self):
+        if self._executor is not None: self._executor.shutdown()
+        if self.workers is not None: self.workers.close()
+        else:
+            for env in self.envs: env.close()
+
     def __len__(self):
         return self.aug_steps(self.max_steps)
 
@@ -633,7 +996,7 @@ class MDPDataset(Dataset):
                 self.env.reset()
                 raise StopIteration
         if self.item is None or self.item.d:
-            return self.env.reset(), self.image
+            return self.env.reset(), self.image if self._needs_image(0, 0) else None
         return self.s_prime, self.alt_s_prime
 
     def stage_2_env_step(self) -> Tuple[np.array, float, bool, None, np.array]:
@@ -644,28 +1007,119 @@ class MDPDataset(Dataset):
 
         Returns: The state, reward, whether the episode is done, and the image.
         """
-        s_prime, reward, done, _ = self.env.step(self.action.get_single_action())
+        render_fn = self.env_image if self._needs_image(0, self.counter + 1) else None
+        s_prime, reward, done, _, image = repeat_step(self.env, self.action.get_single_action(), self.frame_skip,
+                                                      render_fn, self.feed_type == FEED_TYPE_IMAGE)
         # If we are at the max steps limit but the env is not done, we need to force an env end.
         # However, we need the loop to iterate +1 time for allowing the stage_1_env_reset
         if len(self) - 2 == self.counter: done = True
-        return s_prime, reward, done, _, self.image
+        return s_prime, reward, done, _, image
 
     def new(self, _):
+        continuing = self.item is not None and not self.item.d
         s, alt_s = self.stage_1_env_reset()
         self.s_prime, reward, done, _, self.alt_s_prime = self.stage_2_env_step()
         # If both the current item and the done are both true, then we need to retry the env
         if self.item is not None and self.item.d and done: return self.new(_)
 
         self.state = State(s, self.s_prime, alt_s, self.alt_s_prime,  self.env.observation_space, self.feed_type)
+        # The state is the previous state prime, so share its tensors instead of storing the same observation twice.
+        if continuing and self.item._s_prime is not None:
+            self.state.s = self.item._s_prime
+            if self.item._alt_s_prime is not None: self.state.alt_s = self.item._alt_s_prime
         self.item = MDPStep(self.action, self.state, done, reward, self.episode, self.counter)
+        self._track_reward(0, self.item)
         self.counter += 1
 
         return MDPList([self.item])
 
+    def _reset_envs(self, idx, render):
+        r""" Resets the envs at `idx`, returning their observations and images, which are None where not `render`. """
+        if self.workers is not None: return self.workers.reset(idx, render)
+        return [self.envs[i].reset() for i in idx], [self.env_image(self.envs[i]) if r else None
+                                                     for i, r in zip(idx, render)]
+
+    def _step_envs(self, actions, render):
+        r""" Steps every env with its action, returning the observations, rewards, dones, and images. """
+        if self.workers is not None: return self.workers.step(actions, render)
+        s_primes, rewards, dones, _, images = zip(*[
+            repeat_step(env, a, self.frame_skip, self.env_image if r else None, self.feed_type == FEED_TYPE_IMAGE)
+            for env, a, r in zip(self.envs, actions, render)])
+        return list(s_primes), list(rewards), list(dones), list(images)
+
+    def new_vector(self):
+        r""" Steps every env once, resetting the ones whose episode is done. Returns the new steps of every env. """
+        taken_actions = self.action.taken_action.view(self.n_envs, -1)
+        continuing = [self.items[i] is not None and not self.items[i].d for i in range(self.n_envs)]
+        reset_idx = [i for i in range(self.n_envs) if not continuing[i]]
+        reset_s, reset_alt_s = self._reset_envs(reset_idx, [self._needs_image(i, 0) for i in reset_idx]) \
+            if reset_idx else ([], [])
+        s, alt_s, episodes = list(self.s_primes), list(self.alt_s_primes), [None] * self.n_envs
+        for i, reset_s_i, reset_alt_s_i in zip(reset_idx, reset_s, reset_alt_s):
+            s[i], alt_s[i], episodes[i] = reset_s_i, reset_alt_s_i, self.episode
+            self.counters[i] = 0
+            self.episode += 1
+
+        actions = [Action(taken_action=a, action_space=self.env.action_space) for a in taken_actions]
+        render = [self._needs_image(i, self.counters[i] + 1) for i in range(self.n_envs)]
+        self.s_primes, rewards, dones, self.alt_s_primes = self._step_envs([a.get_single_action() for a in actions],
+                                                                           render)
+        for i in range(self.n_envs):
+            done = dones[i] or self.counters[i] + 1 >= self.max_steps
+            state = State(s[i], self.s_primes[i], alt_s[i], self.alt_s_primes[i], self.env.observation_space,
+                          self.feed_type)
+            if continuing[i] and self.items[i]._s_prime is not None:
+                state.s = self.items[i]._s_prime
+                if self.items[i]._alt_s_prime is not None: state.alt_s = self.items[i]._alt_s_prime
+            episode = self.items[i].episode if continuing[i] else episodes[i]
+            self.items[i] = MDPStep(actions[i], state, done, rewards[i], episode, self.counters[i])
+            self._track_reward(i, self.items[i])
+            self.counters[i] += 1
+
+        self.state, self.item = self.items[-1].state, self.items[-1]
+        return MDPList(list(self.items))
+
+    def step_async(self, act: Callable[[], None] = None):
+        r"""
+        Starts the next step on a background thread, which `__getitem__` then picks up instead of stepping.
+
+        With a `policy_lag` of 0, the action is chosen in `MDPCallback.on_batch_begin` before the model optimizes, so
+        the step uses the same policy as it would serially, while `env.step` and rendering overlap with the
+        optimization. With a `policy_lag` of 1, `act` sets the action on the background thread first, predicting with
+        a copy of the weights from before the update, so predicting overlaps with the optimization too. `MDPCallback`
+        waits for the step at the end of every batch, so the env is never touched by two threads at once. Envs that
+        render to a window (`render='human'`) may need to stay on the main thread.
+        """
+        if self._executor is None: self._executor = ThreadPoolExecutor(max_workers=1)
+        step = self.new_vector if self.n_envs != 1 else partial(self.new, None)
+        self._next = self._executor.submit(step if act is None else partial(_act_then_step, act, step))
+
+    def wait_step(self):
+        if self._next is not None: wait([self._next])
+
+    def _new_items(self):
+        if self._next is None: return self.new_vector() if self.n_envs != 1 else self.new(None)
+        future, self._next = self._next, None
+        items = future.result()
+        # The step may have been made in the last batch of an epoch, before `MDPCallback.on_epoch_end` renumbered the
+        # episode. In vector mode, episodes are numbered as they start instead.
+        if self.n_envs == 1: self.item.episode = self.episode
+        return items
+
     def __getitem__(self, _):
-        item = self.new(_)
+        if self.n_envs != 1:
+            items = self._new_items()
+            self.x.add(items)
+            for item in items.items: self.x._update_info(item.episode, item)
+            alt_s_primes = [item.alt_s_prime for item in items.items]
+            # Steps that were not rendered still need a target that collates.
+            return torch.cat([item.s_prime for item in items.items]), \
+                   torch.zeros(0) if any(alt is None for alt in alt_s_primes) else torch.cat(alt_s_primes)
+
+        item = self._new_items()
         self.x.add(item)
-        return self.x[-1]
+        s_prime, alt_s_prime = self.x[-1]
+        return s_prime, ifnone(alt_s_prime, torch.zeros(0))
 
     def to_csv(self, root_path, name):
         if not os.path.exists(root_path): os.makedirs(root_path)
@@ -677,6 +1131,23 @@ class MDPDataset(Dataset):
         pickle.dump(self.x, open(Path(root_path) / (name + ".pickle"), "wb"), pickle.HIGHEST_PROTOCOL)
 
 
+def _act_then_step(act, step):
+    act()
+    return step()
+
+
+def make_env(env_name, res_wrap=None, render=None):
+    r"""
+    Makes the env `env_name`, wrapped by `res_wrap`. If `render` is given, the `WRAP_ENV_FNS` are applied as well,
+    which `MDPDataset` otherwise does itself. It is a module level function so that it can be sent to `EnvWorkers`.
+    """
+    env = gym.make(env_name)
+    env = env if res_wrap is None else res_wrap(env)
+    if render is not None:
+        for wrapper_fn in WRAP_ENV_FNS: env = wrapper_fn(env, render)
+    return env
+
+
 class MDPDataBunch(DataBunch):
 
     @classmethod
@@ -684,8 +1155,8 @@ class MDPDataBunch(DataBunch):
         return MDPDataBunch.from_pickle(path, **kwargs)
 
     def close(self):
-        if self.train_dl is not None: self.train_dl.env.close()
-        if self.valid_dl is not None: self.valid_dl.env.close()
+        if self.train_dl is not None: self.train_dl.dataset.close()
+        if self.valid_dl is not None: self.valid_dl.dataset.close()
 
     @property
     def state_action_sample(self) -> Union[Tuple[State, Action], None]:
@@ -696,17 +1167,39 @@ class MDPDataBunch(DataBunch):
     def from_env(cls, env_name='CartPole-v1', max_steps=None, render='rgb_array', bs: int = 64,
                  feed_type=FEED_TYPE_STATE, num_workers: int = 0, memory_management_strategy='k_top',
                  split_env_init=True, device: torch.device = None, k=1, no_check: bool = False, x=None, val_x=None,
-                 add_valid=True, res_wrap=None, make_dir=True, keep_env_open=True, **dl_kwargs) -> 'MDPDataBunch':
+                 add_valid=True, res_wrap=None, make_dir=True, keep_env_open=True, compress_frames=False, n_envs=1,
+                 env_workers=False, async_step=False, render_policy='always', valid_render_policy=None, frame_skip=1,
+                 policy_lag=0, **dl_kwargs) -> 'MDPDataBunch':
+        r"""
+        `env_workers` runs each of the `n_envs` envs in its own process, writing into shared memory, instead of
+        stepping them one after another in this process. It has no effect for a single env.
+
+        `async_step` steps the envs on a background thread while the model optimizes, see `MDPDataset.step_async`.
+        `policy_lag=1` picks the actions on that thread too, with the weights from before each update.
+
+        `render_policy` decides which steps of the train envs are rendered, see `MDPDataset`. The valid envs use
+        `valid_render_policy` if given, so `render_policy='never', valid_render_policy='always'` only renders
+        evaluation runs.
+        """
 
-        env=gym.make(env_name)
-        if res_wrap is not None: env=res_wrap(env)
+        def make_envs():
+            if n_envs == 1: return make_env(env_name, res_wrap)
+            if env_workers: return EnvWorkers(partial(make_env, env_name, res_wrap, render), n_envs,
+                                              frame_skip=frame_skip, max_pool=feed_type == FEED_TYPE_IMAGE)
+            return [make_env(env_name, res_wrap) for _ in range(n_envs)]
+
+        env=make_envs()
         memory_manager = partial(MDPMemoryManager, strategy=memory_management_strategy, k=k)
         train_list = MDPDataset(env, max_steps=max_steps, feed_type=feed_type, render=render, bs=bs,
-                                memory_manager=memory_manager, x=x, keep_env_open=keep_env_open)
+                                memory_manager=memory_manager, x=x, keep_env_open=keep_env_open,
+                                compress_frames=compress_frames, async_step=async_step, render_policy=render_policy,
+                                k=k, frame_skip=frame_skip, policy_lag=policy_lag)
         if add_valid:
-            if not split_env_init: env=(gym.make(env_name) if res_wrap is not None else res_wrap(gym.make(env_name)))
+            if not split_env_init: env=make_envs()
             valid_list = MDPDataset(env, max_steps=max_steps, x=val_x, keep_env_open=keep_env_open,
-                                    render=render, bs=bs,  feed_type=feed_type, memory_manager=memory_manager)
+                                    render=render, bs=bs,  feed_type=feed_type, memory_manager=memory_manager,
+                                    compress_frames=compress_frames, async_step=async_step, k=k, frame_skip=frame_skip,
+                                    render_policy=ifnone(valid_render_policy, render_policy), policy_lag=policy_lag)
         else:
             valid_list = None
         path = './data/' + datetime.now().strftime('%Y%m%d%H%M%S') + '_' + env_name
@@ -763,7 +1256,7 @@ class MDPDataBunch(DataBunch):
 class MDPList(ItemList):
     _bunch = MDPDataBunch
 
-    def __init__(self, items: Iterator, **kwargs):
+    def __init__(self, items: Iterator, compress_frames=False, **kwargs):
         """
         Represents a MDP sequence over episodes.
 
@@ -777,33 +1270,119 @@ class MDPList(ItemList):
         Args:
             items:
             feed_type:
+            compress_frames: Whether to zlib compress the images of a step once the next step is added. The images of
+                compressed steps are decompressed when accessed through `MDPStep.s`, `MDPStep.s_prime`, and
+                `MDPStep.alt_s_prime`.
             **kwargs:
         """
         # if items is not None:
         super().__init__(items, **kwargs)
         self.info = {}
         self.initial = True
+        self.compress_frames = compress_frames
+        self._compressed = {}
+        # `self.items` is a view of `self._buffer`, which has spare room so that adding does not copy every item.
+        self._buffer = None
+        # The positions of the items of every episode, their summed rewards, and the positions of the done items.
+        self.episodes: Dict[int, List[int]] = {}
+        self.episode_rewards: Dict[int, float] = {}
+        self._dones: List[int] = []
+        self._sync()
+
+    def __getstate__(self):
+        state = copy(self.__dict__)
+        # `self.items` is pickled on its own, so the spare room is not saved.
+        state['_buffer'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._buffer = None
+        self._sync()
+
+    def _index(self, i, item: MDPStep):
+        self.episodes.setdefault(item.episode, []).append(i)
+        self.episode_rewards[item.episode] = self.episode_rewards.get(item.episode, 0.) + float(item.reward)
+        if item.d: self._dones.append(i)
+
+    def _sync(self):
+        r""" Rebuilds the buffer and the episode index if `self.items` was replaced, such as by `filter_by_func`. """
+        if self._buffer is not None and getattr(self.items, 'base', None) is self._buffer: return
+        n = len(self.items)
+        self._buffer = np.empty(max(2 * n, 16), dtype=object)
+        self._buffer[:n] = self.items
+        self.items = self._buffer[:n]
+        self.episodes, self.episode_rewards, self._dones = {}, {}, []
+        for i, item in enumerate(self.items): self._index(i, item)
 
     def filter_by_episode(self, episode):
-        return [i for i in self.items if i.episode == episode]
+        self._sync()
+        return [self.items[i] for i in self.episodes.get(episode, [])]
+
+    def _recent_run(self):
+        r""" Positions of the items after the last done one, not counting the last item. """
+        n = len(self.items)
+        previous_dones = [i for i in self._dones[-2:] if i < n - 1]
+        return list(range(previous_dones[-1] + 1 if previous_dones else 0, n))
 
     def set_recent_run_episode(self, episode):
-        for i, item in enumerate(reversed(self.items)):
-            if item.d and i != 0: break
+        self._sync()
+        run = self._recent_run()
+        if not run: return
+        # Positions are in order and the run is at the end, so it is the tail of the positions of its episodes.
+        for old in {self.items[i].episode for i in run}:
+            positions = self.episodes[old]
+            del positions[bisect_left(positions, run[0]):]
+            self.episode_rewards[old] -= sum(float(self.items[i].reward) for i in run if self.items[i].episode == old)
+            if not positions: del self.episodes[old], self.episode_rewards[old]
+        for i in reversed(run):
+            item = self.items[i]
             item.episode = episode
+            self.episode_rewards[episode] = self.episode_rewards.get(episode, 0.) + float(item.reward)
             self._update_info(episode, item)
+        positions = self.episodes.setdefault(episode, [])
+        positions.extend(run)
+        if len(positions) != len(run) and positions[-len(run) - 1] > run[0]: positions.sort()
 
     def clean(self, episode):
         self.info[episode][1] = True
-        [item.clean() for item in self.items if item.episode == episode]
+        self._sync()
+        for i in self.episodes.get(episode, []): self.items[i].clean()
 
     def _update_info(self, ep, item: MDPStep):
         self.info[ep] = float(np.sum(self.info[ep][0] + float(item.reward))) if ep in self.info else float(item.reward)
         self.info[ep] = [self.info[ep], False]
 
+    def _compress(self, items: List[MDPStep]):
+        r""" Compresses the images of `items`, reusing the frames they share with the previously compressed steps. """
+        compressed = {}
+        for item in items:
+            for k in ('_s', '_s_prime', '_alt_s', '_alt_s_prime'):
+                v = getattr(item, k)
+                if type(v) is not torch.Tensor or len(v.shape) != 4: continue
+                prev = self._compressed.get(id(v))
+                frame = prev[1] if prev is not None and prev[0] is v else CompressedFrame(v.detach().cpu().numpy())
+                compressed[id(v)] = (v, frame)
+                setattr(item, k, frame)
+        self._compressed = compressed
+
     def add(self, items: 'ItemList'):
         # [self._update_info(item.episode, item) for item in items.items]
-        super().add(items)
+        if getattr(self, 'compress_frames', False) and len(self.items) != 0:
+            self._compress(self.items[-getattr(self, '_n_last_added', 1):])
+        # Instead of `ItemList.add`, which concatenates every item into a new array.
+        self._sync()
+        n, new_items = len(self.items), items.items
+        if n + len(new_items) > len(self._buffer):
+            buffer = np.empty(2 * (n + len(new_items)), dtype=object)
+            buffer[:n] = self.items
+            self._buffer = buffer
+        self._buffer[n:n + len(new_items)] = new_items
+        self.items = self._buffer[:n + len(new_items)]
+        for i, item in enumerate(new_items, n): self._index(i, item)
+        self.inner_df = None
+        self._n_last_added = len(new_items)
+        return self
 
     def to_df(self): return pd.DataFrame([i.obj for i in self.items])
 
@@ -8,16 +8,85 @@ Notices:
 
 """
 
+import json
+import pickle
+import tempfile
+from collections import deque
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from pathlib import Path
+
 import numpy as np
 
 
-class SumTree(object):
+class SegmentTree(object):
+    operation = None
+    neutral = 0.
+
+    def __init__(self, capacity):
+        """
+        Binary tree over `capacity` leaves where every parent is `operation` applied to its 2 children.
+
+        Leaves are stored at the end of `tree` starting at `capacity - 1`, so the root (index 0) holds the reduction
+        over every leaf. Leaves that have not been written yet hold `neutral`.
+
+        Args:
+            capacity:
+        """
+        self.capacity = capacity
+        self.tree = np.full(2 * capacity - 1, self.neutral, dtype=float)
+
+    def _propagate(self, idx):
+        """ Rebuilds the ancestors of `idx` from their children a level at a time, up to the root. """
+        while idx.size != 0:
+            idx = np.unique((idx[idx != 0] - 1) // 2)
+            self.tree[idx] = self.operation(self.tree[self.get_left(idx)], self.tree[self.get_right(idx)])
+
+    def get_left(self, index):
+        return 2 * index + 1
+
+    def get_right(self, index):
+        return self.get_left(index) + 1
+
+    def update(self, idx, p):
+        """
+        Update priorities.
+
+        `idx` and `p` can either be scalars or arrays. Since parents are rebuilt from their children instead of
+        accumulating changes, duplicate and sibling indexes are safe to pass together. For duplicates, the last
+        priority wins.
+        """
+        idx = np.reshape(idx, -1).astype(int)
+        p = np.broadcast_to(np.reshape(p, -1), idx.shape)
+        # Keep the last occurrence of each duplicated index.
+        idx, last = np.unique(idx[::-1], return_index=True)
+        self.tree[idx] = p[::-1][last]
+        self._propagate(idx)
+
+
+class MinTree(SegmentTree):
+    operation = np.minimum
+    neutral = np.inf
+
+
+class MaxTree(SegmentTree):
+    operation = np.maximum
+    neutral = 0.
+
+
+class SumTree(SegmentTree):
+    operation = np.add
+    neutral = 0.
     write = 0
 
     def __init__(self, capacity):
         """
         Used for PER.
 
+        Keeps a `MinTree` and a `MaxTree` over the same leaves in sync, so the smallest and largest priorities can be
+        read from their roots without scanning the leaves.
+
         References:
               [1] SumTree implementation belongs to: https://github.com/rlcode/per
 
@@ -28,40 +97,27 @@ class SumTree(object):
         Args:
             capacity:
         """
-
-        self.capacity = capacity
-        self.tree = np.zeros(2 * capacity - 1)
+        super().__init__(capacity)
+        self.min_tree = MinTree(capacity)
+        self.max_tree = MaxTree(capacity)
         self.data = np.zeros(capacity, dtype=object)
         self.n_entries = 0
 
-    def _propagate(self, idx, change):
-        """ Update to the root node """
-        parent = (idx - 1) // 2
-
-        self.tree[parent] += change
+    def _retrieve(self, s):
+        """ Finds the leaf nodes for an array of samples, descending all of them one level at a time. """
+        s = np.array(s, dtype=float).reshape(-1, )
+        idx = np.zeros(s.shape[0], dtype=int)
 
-        if (np.isscalar(parent) and parent != 0) or (not np.isscalar(parent) and all(parent != 0)):
-            if not np.isscalar(parent): change[parent == 0] = 0
-            self._propagate(parent, change)
+        while True:
+            left = self.get_left(idx)
+            # Leaves can sit on different levels when the capacity is not a power of 2, so some samples finish early.
+            descending = left < len(self.tree)
+            if not np.any(descending): return idx
 
-    def get_left(self, index):
-        return 2 * index + 1
-
-    def get_right(self, index):
-        return self.get_left(index) + 1
-
-    def _retrieve(self, idx, s):
-        """ Finds sample on leaf node """
-        left = self.get_left(idx)
-        right = self.get_right(idx)
-
-        if left >= len(self.tree):
-            return idx
-
-        if s <= self.tree[left]:
-            return self._retrieve(left, s)
-        else:
-            return self._retrieve(right, s - self.tree[left])
+            left, s_descending = left[descending], s[descending]
+            go_right = s_descending > self.tree[left]
+            s[descending] = np.where(go_right, s_descending - self.tree[left], s_descending)
+            idx[descending] = left + go_right
 
     def total(self):
         return self.tree[0]
@@ -81,28 +137,718 @@ class SumTree(object):
             self.n_entries += 1
 
     def update(self, idx, p):
-        """ Update priority """
-        p = p.flatten() if not np.isscalar(p) else p
-        change = p - self.tree[idx]
+        """ Update priorities in this tree and in its min / max companions. """
+        super().update(idx, p)
+        # Leaves with a priority of 0 can never be sampled, so they should not count as the smallest priority.
+        self.min_tree.update(idx, np.where(np.asarray(p) > 0, p, np.inf))
+        self.max_tree.update(idx, p)
 
-        self.tree[idx] = p
-        self._propagate(idx, change)
+    def min(self):
+        return self.min_tree.tree[0]
+
+    def max(self):
+        return self.max_tree.tree[0]
 
     def get(self, s):
         """ Get priority and sample """
-        idx = self._retrieve(0, s)
+        idx = self._retrieve(s)[0]
         data_index = idx - self.capacity + 1
 
         return idx, self.tree[idx], self.data[data_index]
 
+    def remove(self, idx):
+        """ Sets the priorities at tree indices `idx` to 0, so they are never sampled again. """
+        self.update(idx, 0)
+
+    def probabilities(self, priorities):
+        """ Sampling probabilities of the sampled `priorities`. """
+        return priorities / self.total()
+
+    def min_probability(self):
+        return self.min() / self.total()
+
     def anneal_weights(self, priorities, beta):
         sampling_probabilities = priorities / self.total()
         is_weight = np.power(self.n_entries * sampling_probabilities, -beta)
-        is_weight /= is_weight.max()
+        # The largest weight in the tree belongs to the smallest priority, which is not always in this batch.
+        is_weight /= np.power(self.n_entries * self.min() / self.total(), -beta)
         return is_weight.astype(float)
 
     def batch_get(self, ss):
-        return np.array(list(zip(*list([self.get(s) for s in ss if self.get(s)[2] != 0]))))
+        """
+        Get the priorities and samples for an array of cumulative priorities `ss` in a single pass.
+
+        Leaves that have not been filled yet are dropped, so the returned arrays can be shorter than `ss`.
+
+        Returns:
+            The tree indexes, their priorities, and their data as 3 arrays.
+        """
+        idx = self._retrieve(ss)
+        data_index = idx - self.capacity + 1
+        filled = data_index < self.n_entries
+        idx, data_index = idx[filled], data_index[filled]
+        return idx, self.tree[idx], self.data[data_index]
+
+
+class RankHeap(object):
+    def __init__(self, capacity, alpha=0.7, sort_every=None, n_partitions=100):
+        """
+        Keeps priorities in an array based binary max heap, using the heap position of a sample as its rank.
+
+        A heap is only approximately sorted, so it is fully re-sorted every `sort_every` updates instead of on every
+        update. A sorted array is also a valid heap, so adds and updates in between stay O(log N).
+
+        The rank distribution is split into `batch` segments of equal probability, and one sample is drawn uniformly
+        from each segment. The boundaries only depend on the number of samples, so they are precomputed, and only
+        recomputed every `capacity / n_partitions` adds while the heap is filling up.
+
+        References:
+            [1] Schaul, Tom, et al. "Prioritized experience replay." arXiv preprint arXiv:1511.05952 (2015).
+
+        Args:
+            capacity: Max N samples to store.
+            alpha: Changes the sampling behavior 1 (non-uniform) -> 0 (uniform).
+            sort_every: Number of updates between full sorts. Defaults to `capacity`.
+            n_partitions: Number of sizes the segment boundaries are computed for while filling up.
+        """
+        self.capacity = capacity
+        self.alpha = alpha
+        self.sort_every = capacity if sort_every is None else sort_every
+        self.partition_size = max(1, capacity // n_partitions)
+        self.priorities = np.zeros(capacity)
+        # Data index at each heap position, and the heap position of each data index.
+        self.heap = np.zeros(capacity, dtype=np.int64)
+        self.positions = np.full(capacity, -1, dtype=np.int64)
+        self.data = np.zeros(capacity, dtype=object)
+        self.write = 0
+        self.n_entries = 0
+        self.n_updates = 0
+        self._segments = None
+
+    def _swap(self, i, j):
+        self.priorities[i], self.priorities[j] = self.priorities[j], self.priorities[i]
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.positions[self.heap[i]], self.positions[self.heap[j]] = i, j
+
+    def _fix(self, pos):
+        """ Sifts the sample at heap position `pos` up or down until the heap is valid again. """
+        while pos != 0 and self.priorities[(pos - 1) // 2] < self.priorities[pos]:
+            self._swap(pos, (pos - 1) // 2)
+            pos = (pos - 1) // 2
+        while 2 * pos + 1 < self.n_entries:
+            child = 2 * pos + 1
+            if child + 1 < self.n_entries and self.priorities[child + 1] > self.priorities[child]: child += 1
+            if self.priorities[child] <= self.priorities[pos]: break
+            self._swap(pos, child)
+            pos = child
+
+    def add(self, p, data):
+        """ Store `data` with priority `p`, overwriting the oldest sample once full. """
+        idx = self.write
+        self.data[idx] = data
+        if self.positions[idx] == -1:
+            self.heap[self.n_entries], self.positions[idx] = idx, self.n_entries
+            self.n_entries += 1
+        self.priorities[self.positions[idx]] = p
+        self._fix(self.positions[idx])
+
+        self.write += 1
+        if self.write >= self.capacity:
+            self.write = 0
+
+    def _sift_down(self, pos):
+        """ Sifts the samples at heap positions `pos` down at once, which needs their subtrees to be disjoint. """
+        n = self.n_entries
+        while len(pos) != 0:
+            child = 2 * pos + 1
+            if child[-1] >= n: pos, child = pos[child < n], child[child < n]
+            right = np.minimum(child + 1, n - 1)
+            p_child, p_right = self.priorities[child], self.priorities[right]
+            larger = p_right > p_child
+            child, p_child = np.where(larger, right, child), np.where(larger, p_right, p_child)
+            p_pos = self.priorities[pos]
+            swap = p_child > p_pos
+            pos, child = pos[swap], child[swap]
+            self.priorities[pos], self.priorities[child] = p_child[swap], p_pos[swap]
+            moved_up, moved_down = self.heap[child], self.heap[pos]
+            self.heap[pos], self.heap[child] = moved_up, moved_down
+            self.positions[moved_up], self.positions[moved_down] = pos, child
+            pos = child
+
+    def _heapify(self, pos):
+        """
+        Makes the heap valid again after the priorities at heap positions `pos` changed, by sifting down those
+        positions, and the parents that they now exceed, from the deepest level up. Positions on the same level have
+        disjoint subtrees, so each level is sifted at once.
+        """
+        pos = np.unique(pos)
+        if len(pos) == 0: return
+        depth = np.floor(np.log2(pos + 1)).astype(int)
+        parents = pos[:0]
+        for d in range(depth.max(), -1, -1):
+            level = np.union1d(pos[depth == d], parents)
+            if len(level) == 0: continue
+            self._sift_down(level)
+            level = level[level != 0]
+            parents = (level - 1) // 2
+            parents = parents[self.priorities[level] > self.priorities[parents]]
+
+    def update(self, idx, p):
+        """ Updates the priorities of the samples at data indices `idx`. Broadcasts `p` if it is a scalar. """
+        idx = np.asarray(idx).reshape(-1)
+        self.priorities[self.positions[idx]] = np.broadcast_to(np.asarray(p, dtype=float).reshape(-1), idx.shape)
+        self._heapify(self.positions[idx])
+
+        self.n_updates += len(idx)
+        if self.n_updates >= self.sort_every: self.sort()
+
+    def remove(self, idx):
+        """ Removes the samples at data indices `idx` from the heap, so they are never sampled again. """
+        pos = np.unique(self.positions[np.asarray(idx).reshape(-1)])
+        pos = pos[pos != -1]
+        if len(pos) == 0: return
+        self.positions[self.heap[pos]] = -1
+        n_entries = self.n_entries - len(pos)
+        # The kept samples past the new end of the heap fill the holes left before it.
+        holes, tail = pos[pos < n_entries], np.setdiff1d(np.arange(n_entries, self.n_entries), pos)
+        self.priorities[holes], self.heap[holes] = self.priorities[tail], self.heap[tail]
+        self.positions[self.heap[holes]] = holes
+        self.n_entries = n_entries
+        self._heapify(holes)
+
+    def sort(self):
+        """ Fully sorts the heap by descending priority, so heap positions are exact ranks. """
+        order = np.argsort(-self.priorities[:self.n_entries], kind='stable')
+        self.priorities[:self.n_entries] = self.priorities[order]
+        self.heap[:self.n_entries] = self.heap[order]
+        self.positions[self.heap[:self.n_entries]] = np.arange(self.n_entries)
+        self.n_updates = 0
+
+    def max(self):
+        return self.priorities[0] if self.n_entries != 0 else 0
+
+    def segments(self, batch):
+        """ Returns the start and end ranks of `batch` equally probable segments, and the probability of each rank. """
+        n = self.n_entries
+        if n >= self.partition_size: n -= n % self.partition_size
+        if self._segments is None or self._segments[0] != (n, batch):
+            probabilities = np.power(np.arange(1, n + 1, dtype=float), -self.alpha)
+            probabilities /= probabilities.sum()
+            bounds = np.searchsorted(np.cumsum(probabilities), np.linspace(0, 1, batch + 1)[1:-1])
+            start, end = np.concatenate([[0], bounds]).clip(max=n - 1), np.concatenate([bounds, [n]])
+            self._segments = ((n, batch), start, np.maximum(end, start + 1).clip(max=n), probabilities)
+        return self._segments[1:]
+
+    def sample(self, batch):
+        """ Draws a rank from each of `batch` segments, returning the data indices, probabilities, and data. """
+        start, end, probabilities = self.segments(batch)
+        ranks = np.random.randint(start, end)
+        idx = self.heap[ranks]
+        return idx, probabilities[ranks], self.data[idx]
+
+    def probabilities(self, probabilities):
+        """ Sampling probabilities of the sampled `probabilities`, which `sample` already returns. """
+        return probabilities
+
+    def min_probability(self):
+        return self._segments[3][-1]
+
+    def anneal_weights(self, probabilities, beta):
+        """ Importance sampling weights of the sampled `probabilities`, normalized by the smallest probability. """
+        n = len(self._segments[3])
+        return np.power(n * probabilities, -beta) / np.power(n * self._segments[3][-1], -beta)
+
+
+class ArrayBuffer(object):
+    def __init__(self, capacity):
+        """
+        Ring buffer that stores transitions as preallocated columns instead of as individual objects.
+
+        Columns are allocated on the first `add` since their shapes and dtypes come from the first transition. New
+        transitions are written in place at `write`, overwriting the oldest transition once the buffer is full.
+
+        Args:
+            capacity: Max N transitions to store.
+        """
+        self.capacity = capacity
+        self.columns = {}
+        self.write = 0
+        self.n_entries = 0
+
+    def __len__(self):
+        return self.n_entries
+
+    def _allocate(self, fields):
+        """ Creates a column for every field using its shape and dtype. """
+        return {k: np.zeros((self.capacity,) + np.shape(v), dtype=np.asarray(v).dtype) for k, v in fields.items()}
+
+    def add(self, **fields):
+        """ Store the fields of a single transition, and return the index they were written to. """
+        if not self.columns: self.columns = self._allocate(fields)
+
+        idx = self.write
+        for k, v in fields.items(): self.columns[k][idx] = v
+
+        self.write += 1
+        if self.write >= self.capacity:
+            self.write = 0
+
+        if self.n_entries < self.capacity:
+            self.n_entries += 1
+        return idx
+
+    def is_valid(self, idx):
+        """ Whether the transitions at `idx` can be sampled. """
+        return np.asarray(idx) < self.n_entries
+
+    def get(self, idx, keys=None):
+        """ Gather the columns at `idx` into new contiguous arrays, only gathering `keys` if given. """
+        return {k: np.take(self.columns[k], idx, axis=0) for k in (self.columns if keys is None else keys)}
+
+    def sample_idx(self, batch):
+        """ Uniformly sample `batch` indices with replacement, or all of them if there are fewer than `batch`. """
+        if self.n_entries < batch: return np.arange(self.n_entries)
+        return np.random.randint(0, self.n_entries, size=batch)
+
+    def sample(self, batch):
+        """ Uniformly sample `batch` transitions with replacement, or all of them if there are fewer than `batch`. """
+        return self.get(self.sample_idx(batch))
+
+
+class MemMapBuffer(ArrayBuffer):
+    def __init__(self, capacity, path=None, mapped=('s', 's_prime')):
+        """
+        `ArrayBuffer` that keeps the observation columns in a `numpy.memmap` file instead of in RAM.
+
+        The file holds `capacity` fixed size records, where each record contains the `mapped` fields of a single
+        transition. The remaining small columns (actions, rewards, dones) stay in RAM. Sampling gathers directly from
+        the mapped pages, so only the sampled records are read from disk.
+
+        Args:
+            capacity: Max N transitions to store.
+            path: File to map. If None, an anonymous temporary file is used, which is removed with the buffer.
+            mapped: Names of the fields to store in the file.
+        """
+        super().__init__(capacity)
+        self.path = path
+        self.mapped = mapped
+        self.records = None
+        self._file = None
+
+    def _allocate(self, fields):
+        columns = super()._allocate({k: v for k, v in fields.items() if k not in self.mapped})
+        dtype = np.dtype([(k, np.asarray(fields[k]).dtype, np.shape(fields[k])) for k in self.mapped if k in fields])
+        if self.path is None: self._file = tempfile.TemporaryFile()
+        self.records = np.memmap(self._file if self.path is None else self.path, dtype=dtype, mode='w+',
+                                 shape=(self.capacity,))
+        columns.update({k: self.records[k] for k in dtype.names})
+        return columns
+
+    def flush(self):
+        """ Writes any pending changes of the mapped records to the file. """
+        if self.records is not None: self.records.flush()
+
+    def __getstate__(self):
+        # The columns are views of the records, so the records do not need to be pickled too.
+        state = copy(self.__dict__)
+        state.update(records=None, _file=None)
+        return state
+
+
+class FrameBuffer(ArrayBuffer):
+    def __init__(self, capacity, n_frames=None):
+        """
+        `ArrayBuffer` that stores every observation once in a frame table, and only keeps frame ids per transition.
+
+        Consecutive transitions share a frame since s' of one step is s of the next, so a transition usually only
+        adds its s' to the table. s is only written when it differs from the last written frame, such as after an
+        env reset. Both are rebuilt from the frame table when sampled.
+
+        Frame ids keep increasing, and the frame table is a ring of `n_frames`. A transition whose s frame has been
+        overwritten is dropped, which only happens to the oldest transitions when episodes are very short.
+
+        Args:
+            capacity: Max N transitions to store.
+            n_frames: Size of the frame table. Each transition needs 1 frame plus 1 per episode start, so this
+                      defaults to 1.25 * capacity.
+        """
+        super().__init__(capacity)
+        self.n_frames = capacity + capacity // 4 + 1 if n_frames is None else n_frames
+        self.frames = None
+        self.frames_written = 0
+        self.n_valid = 0
+
+    def __len__(self):
+        return self.n_valid
+
+    def _add_frame(self, frame):
+        """ Store a frame, returning its id. """
+        if self.frames is None:
+            self.frames = np.zeros((self.n_frames,) + np.shape(frame), dtype=np.asarray(frame).dtype)
+        self.frames[self.frames_written % self.n_frames] = frame
+        self.frames_written += 1
+        return self.frames_written - 1
+
+    def add(self, s, s_prime, **fields):
+        """ Store the fields of a single transition, and return the index they were written to. """
+        last_frame = self.frames_written - 1
+        if self.frames is not None and np.array_equal(self.frames[last_frame % self.n_frames], s): s_id = last_frame
+        else: s_id = self._add_frame(s)
+        idx = super().add(s_id=np.int64(s_id), s_prime_id=np.int64(self._add_frame(s_prime)), **fields)
+
+        # The oldest transitions are the first to lose their frames, so only they need checking.
+        self.n_valid = min(self.n_valid + 1, self.capacity)
+        while self.n_valid != 0 and self.columns['s_id'][self._oldest] < self.frames_written - self.n_frames:
+            self.n_valid -= 1
+        return idx
+
+    @property
+    def _oldest(self):
+        return (self.write - self.n_valid) % self.capacity
+
+    def is_valid(self, idx):
+        return (np.asarray(idx) - self._oldest) % self.capacity < self.n_valid
+
+    def get(self, idx, keys=None):
+        """ Gather the columns at `idx`, rebuilding s and s' from the frame table. """
+        if keys is not None: keys = [k + '_id' if k in ('s', 's_prime') else k for k in keys]
+        fields = super().get(idx, keys)
+        for k in ('s', 's_prime'):
+            if k + '_id' in fields: fields[k] = np.take(self.frames, fields.pop(k + '_id') % self.n_frames, axis=0)
+        return fields
+
+    def sample_idx(self, batch):
+        """ Uniformly sample `batch` valid indices with replacement, or all of them if there are fewer. """
+        offsets = np.arange(self.n_valid) if self.n_valid < batch else np.random.randint(0, self.n_valid, size=batch)
+        return (self._oldest + offsets) % self.capacity
+
+
+class SequenceBuffer(ArrayBuffer):
+    def __init__(self, capacity, seq_len=8):
+        """
+        `ArrayBuffer` that also samples fixed length windows of consecutive transitions from the same episode.
+
+        Every transition is stored with its episode id and a global step counter. A window of `seq_len` rows starting
+        anywhere is gathered in one go, and the rows that belong to another episode, or that were overwritten or not
+        written yet, are zeroed out and masked.
+
+        Args:
+            capacity: Max N transitions to store.
+            seq_len: Length of the sampled windows.
+        """
+        super().__init__(capacity)
+        self.seq_len = seq_len
+        self.episode = 0
+        self.t = 0
+
+    def add(self, **fields):
+        """ Store the fields of a single transition, and return the index they were written to. """
+        idx = super().add(episode=np.int64(self.episode), t=np.int64(self.t), **fields)
+        self.t += 1
+        if np.asarray(fields.get('done', 0)).any(): self.episode += 1
+        return idx
+
+    def get_windows(self, starts):
+        """ Gather the windows starting at `starts` as [batch, seq_len, ...] arrays, along with a `mask`. """
+        steps = np.arange(self.seq_len)
+        fields = self.get((np.asarray(starts).reshape(-1, 1) + steps) % self.capacity)
+        episode, t = fields.pop('episode'), fields.pop('t')
+        mask = (episode == episode[:, :1]) & (t == t[:, :1] + steps)
+        for v in fields.values(): v[~mask] = 0
+        fields['mask'] = mask
+        return fields
+
+    def sample_windows(self, batch):
+        """ Uniformly sample `batch` windows with replacement, or all of them if there are fewer than `batch`. """
+        return self.get_windows(self.sample_idx(batch))
+
+
+class HindsightBuffer(ArrayBuffer):
+    def __init__(self, capacity, achieved_goal: slice, desired_goal: slice, compute_reward, k_future=4):
+        """
+        `ArrayBuffer` for flattened GoalEnv observations, that relabels sampled batches with the "future" strategy.
+
+        Each transition is stored with the achieved goal of its s_prime, its episode, and a global step counter.
+        Since the transitions of an episode are in consecutive rows, a future transition of the same episode is
+        found by offsetting the sampled rows. A whole batch is relabeled at once: the desired goals in s and s_prime
+        are replaced with the achieved goals of the future transitions, and the rewards are recomputed by a single
+        `compute_reward` call over arrays. Envs whose `compute_reward` only handles single goals are called per
+        sample instead.
+
+        References:
+            [1] Andrychowicz, Marcin, et al. "Hindsight experience replay."
+            Advances in Neural Information Processing Systems. 2017.
+
+        Args:
+            capacity: Max N transitions to store.
+            achieved_goal: Slice of the achieved goal in a flattened observation.
+            desired_goal: Slice of the desired goal in a flattened observation.
+            compute_reward: The `compute_reward(achieved_goal, desired_goal, info)` of the GoalEnv.
+            k_future: Number of relabeled samples per original sample, so `k_future / (k_future + 1)` of a batch
+                      is relabeled.
+        """
+        super().__init__(capacity)
+        self.achieved_goal = achieved_goal
+        self.desired_goal = desired_goal
+        self.compute_reward = compute_reward
+        self.future_p = 1 - 1. / (1 + k_future)
+        self.vectorized = True
+        self.episode = 0
+        self.t = 0
+        # The step counter of the last transition of each episode, indexed by episode % capacity.
+        self.episode_end = np.zeros(capacity, dtype=np.int64)
+
+    def add(self, **fields):
+        """ Store the fields of a single transition, and return the index they were written to. """
+        idx = super().add(episode=np.int64(self.episode), t=np.int64(self.t),
+                          achieved_goal=np.asarray(fields['s_prime'])[..., self.achieved_goal], **fields)
+        self.episode_end[self.episode % self.capacity] = self.t
+        self.t += 1
+        if np.asarray(fields.get('done', 0)).any(): self.episode += 1
+        return idx
+
+    def rewards(self, achieved_goal, desired_goal):
+        """ Calls `compute_reward` over the whole batch, or per sample if it cannot handle arrays. """
+        if self.vectorized:
+            try:
+                reward = np.asarray(self.compute_reward(achieved_goal, desired_goal, None))
+                if reward.size == len(achieved_goal): return reward
+            except (ValueError, TypeError, IndexError): pass
+            self.vectorized = False
+        return np.array([self.compute_reward(ag, g, None) for ag, g in zip(achieved_goal, desired_goal)])
+
+    def relabel(self, idx):
+        """ Gather the transitions at `idx`, relabeling a `future_p` fraction of them with future achieved goals. """
+        meta_keys = ('episode', 't', 'achieved_goal')
+        fields = self.get(idx, keys=[k for k in self.columns if k not in meta_keys])
+        meta = self.get(idx, keys=meta_keys)
+        relabeled = np.flatnonzero(np.random.uniform(size=len(idx)) < self.future_p)
+        if len(relabeled) == 0: return fields
+
+        t = meta['t'][relabeled]
+        n_future = self.episode_end[meta['episode'][relabeled] % self.capacity] - t + 1
+        offsets = np.floor(np.random.uniform(size=len(relabeled)) * n_future).astype(int)
+        future = (idx[relabeled] + offsets) % self.capacity
+        goals = np.take(self.columns['achieved_goal'], future, axis=0)
+
+        fields['s'][relabeled, ..., self.desired_goal] = goals
+        fields['s_prime'][relabeled, ..., self.desired_goal] = goals
+        reward = self.rewards(meta['achieved_goal'][relabeled], goals)
+        fields['reward'][relabeled] = reward.reshape(len(relabeled), -1).astype(fields['reward'].dtype)
+        return fields
+
+
+class NStepReturns(object):
+    def __init__(self, capacity, n_step=3, gamma=0.99):
+        """
+        Keeps the discounted n-step return of every transition in a buffer, next to the buffer's own columns.
+
+        The transitions of the current episode that have not seen `n_step` rewards yet are kept in a rolling window.
+        Every added transition adds its discounted reward to the returns of the window, and becomes their bootstrap
+        transition, whose s' is the state the returns bootstrap from. So a transition always holds a complete target,
+        truncated at the newest transition until `n_step` rewards have been seen, or at the end of the episode.
+
+        Args:
+            capacity: Max N transitions to store. Should be the capacity of the buffer the indices belong to.
+            n_step: Number of rewards to sum before bootstrapping.
+            gamma: Discount of the rewards.
+        """
+        self.n_step = n_step
+        self.gamma = gamma
+        self.reward = np.zeros((capacity, 1), dtype=np.float32)
+        # gamma^n, or 0 when the episode ended before the bootstrap state.
+        self.discount = np.zeros((capacity, 1), dtype=np.float32)
+        self.bootstrap = np.zeros(capacity, dtype=np.int64)
+        self.window = deque(maxlen=n_step)
+
+    def add(self, idx, reward, done):
+        """ Updates the returns of the window with the transition at `idx`. A done transition closes the window. """
+        self.reward[idx] = 0
+        self.window.append(idx)
+        window = np.array(self.window)
+        steps = np.arange(len(window))[::-1]
+        self.reward[window] += np.power(self.gamma, steps).reshape(-1, 1) * np.asarray(reward).reshape(1, -1)
+        self.discount[window] = np.power(self.gamma, steps + 1).reshape(-1, 1) * (1 - float(np.asarray(done).max()))
+        self.bootstrap[window] = idx
+        if np.asarray(done).any(): self.window.clear()
+
+    def get(self, idx):
+        """ Returns the n-step rewards, discounts, and bootstrap indices of the transitions at `idx`. """
+        return np.take(self.reward, idx, axis=0), np.take(self.discount, idx, axis=0), np.take(self.bootstrap, idx)
+
+
+class CompressedFrame(object):
+    __slots__ = ('data', 'shape', 'dtype')
+
+    def __init__(self, frame, level=1):
+        """ Keeps a single frame as zlib compressed bytes, along with what is needed to restore it. """
+        frame = np.ascontiguousarray(frame)
+        self.data, self.shape, self.dtype = zlib.compress(frame.tobytes(), level), frame.shape, frame.dtype
+
+    def numpy(self):
+        return np.frombuffer(bytearray(zlib.decompress(self.data)), dtype=self.dtype).reshape(self.shape)
+
+    @classmethod
+    def from_bytes(cls, data, shape, dtype):
+        """ Restores a frame from its already compressed bytes. """
+        frame = cls.__new__(cls)
+        frame.data, frame.shape, frame.dtype = data, shape, np.dtype(dtype)
+        return frame
+
+
+def decompress_frames(frames, pool: ThreadPoolExecutor = None):
+    """
+    Decompresses many `CompressedFrame`s at once, stacking them along a new first dimension.
+
+    zlib releases the GIL while decompressing, so the frames are decompressed in parallel on `pool`. If `pool` is
+    None, a temporary one is used.
+    """
+    if pool is None:
+        with ThreadPoolExecutor() as pool: return decompress_frames(frames, pool)
+    return np.stack(list(pool.map(CompressedFrame.numpy, frames)))
+
+
+class CompressedBuffer(ArrayBuffer):
+    def __init__(self, capacity, compressed=('s', 's_prime'), level=1, n_workers=4):
+        """
+        `ArrayBuffer` that zlib compresses every observation on its own, for image feeds.
+
+        Compressed frames have different sizes, so their columns hold `CompressedFrame`s instead of being preallocated.
+        A sampled batch is decompressed in bulk on a thread pool.
+
+        Args:
+            capacity: Max N transitions to store.
+            compressed: Names of the fields to compress.
+            level: zlib compression level. Low levels are much faster and still shrink rendered frames a lot.
+            n_workers: Number of threads used for decompressing.
+        """
+        super().__init__(capacity)
+        self.compressed = compressed
+        self.level = level
+        self.n_workers = n_workers
+        self.pool = ThreadPoolExecutor(n_workers)
+
+    def __getstate__(self):
+        state = copy(self.__dict__)
+        state['pool'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool = ThreadPoolExecutor(self.n_workers)
+
+    def _allocate(self, fields):
+        columns = super()._allocate({k: v for k, v in fields.items() if k not in self.compressed})
+        columns.update({k: np.empty(self.capacity, dtype=object) for k in self.compressed if k in fields})
+        return columns
+
+    def add(self, **fields):
+        """ Store the fields of a single transition, and return the index they were written to. """
+        return super().add(**{k: CompressedFrame(v, self.level) if k in self.compressed else v
+                              for k, v in fields.items()})
+
+    def get(self, idx, keys=None):
+        """ Gather the columns at `idx`, decompressing the compressed ones in bulk. """
+        fields = super().get(idx, keys)
+        for k in self.compressed:
+            if k in fields: fields[k] = decompress_frames(fields[k], self.pool)
+        return fields
+
+
+_STRUCTURES = (SegmentTree, RankHeap, ArrayBuffer, NStepReturns)
+
+
+def _save_array(path, key, v):
+    """ Saves `v` as `key`.npy in `path`, returning how to load it back. """
+    if v.dtype != object:
+        np.save(path / f'{key}.npy', v)
+        return {'kind': 'array'}
+
+    frames = [x for x in v if x is not None]
+    if frames and all(isinstance(x, CompressedFrame) for x in frames):
+        np.save(path / f'{key}.npy', np.frombuffer(b''.join(x.data for x in frames), dtype=np.uint8))
+        np.save(path / f'{key}.lengths.npy', np.array([-1 if x is None else len(x.data) for x in v], dtype=np.int64))
+        return {'kind': 'frames', 'shape': list(frames[0].shape), 'dtype': frames[0].dtype.str}
+
+    if not all(isinstance(x, (int, np.integer)) for x in v):
+        raise TypeError(f'{key} holds python objects, which cannot be saved as an array.')
+    np.save(path / f'{key}.npy', v.astype(np.int64))
+    return {'kind': 'array'}
+
+
+def _load_array(path, key, meta, mmap_mode):
+    v = np.load(path / f'{key}.npy', mmap_mode=mmap_mode)
+    if meta['kind'] != 'frames': return v
+
+    lengths = np.load(path / f'{key}.lengths.npy')
+    starts = np.cumsum(np.concatenate([[0], lengths.clip(min=0)]))
+    frames = np.empty(len(lengths), dtype=object)
+    shape, dtype = tuple(meta['shape']), meta['dtype']
+    for i in np.flatnonzero(lengths != -1):
+        frames[i] = CompressedFrame.from_bytes(v[starts[i]:starts[i + 1]].tobytes(), shape, dtype)
+    return frames
+
+
+def _items(obj):
+    if isinstance(obj, dict): return list(obj.items())
+    if isinstance(obj, list): return list(enumerate(obj))
+    return list(vars(obj).items())
+
+
+def _split(obj, prefix, path, manifest, structures):
+    """ Saves the arrays of `obj` and of the structures it holds in `path`, returning a copy of `obj` without them. """
+    skeleton = copy(obj)
+    for k, v in _items(skeleton):
+        if isinstance(v, (dict, list) + _STRUCTURES + structures):
+            v = _split(v, f'{prefix}{k}.', path, manifest, structures)
+        elif isinstance(v, np.ndarray):
+            manifest[f'{prefix}{k}'] = _save_array(path, f'{prefix}{k}', v)
+            v = None
+        else: continue
+
+        if isinstance(skeleton, (dict, list)): skeleton[k] = v
+        else: setattr(skeleton, k, v)
+    return skeleton
+
+
+def save_state(obj, path, structures=()):
+    """
+    Saves `obj` into the directory `path`, writing the arrays of it and of the replay structures it holds as .npy
+    files, and pickling the rest, which is small.
+
+    Object arrays of ints, such as the data of a `SumTree` using a buffer, are saved as int64 arrays, and
+    `CompressedFrame` columns are saved as a single blob of bytes. Any other python objects raise a `TypeError`.
+    `structures` are extra classes whose arrays are saved too, such as the replay memories held by a sharded one.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    manifest = {}
+    skeleton = _split(obj, '', path, manifest, tuple(structures))
+    with open(path / 'manifest.json', 'w') as f: json.dump(manifest, f)
+    with open(path / 'state.pkl', 'wb') as f: pickle.dump(skeleton, f, pickle.HIGHEST_PROTOCOL)
+
+
+def load_state(path, mmap_mode='c'):
+    """
+    Loads an object saved by `save_state`. The arrays are memory mapped, so only the pages that are used are read.
+
+    The default copy on write mode keeps the saved files unchanged while the loaded object is modified.
+    """
+    path = Path(path)
+    with open(path / 'manifest.json') as f: manifest = json.load(f)
+    with open(path / 'state.pkl', 'rb') as f: obj = pickle.load(f)
+    for key, meta in manifest.items():
+        *parents, name = key.split('.')
+        target = obj
+        for parent in parents:
+            if isinstance(target, dict): target = target[parent]
+            elif isinstance(target, list): target = target[int(parent)]
+            else: target = getattr(target, parent)
+        v = _load_array(path, key, meta, mmap_mode)
+        if isinstance(target, dict): target[name] = v
+        elif isinstance(target, list): target[int(name)] = v
+        else: setattr(target, name, v)
+    return obj
 
 
 def print_tree(tree: SumTree):
@@ -0,0 +1,175 @@
+from multiprocessing import get_context
+from typing import Callable, List
+
+import gym
+import numpy as np
+
+from fast_rl.util.misc import flatten_dict_obs
+
+
+def _obs_array(obs, observation_space: gym.Space):
+    r""" Dict observations, such as the ones of a GoalEnv, are flattened the same way `State` does it. """
+    if isinstance(observation_space, gym.spaces.Dict): return flatten_dict_obs(obs, observation_space)
+    return np.asarray(obs)
+
+
+def _image(env):
+    try: return env.render('rgb_array')
+    except NotImplementedError: return None
+
+
+def repeat_step(env, action, frame_skip=1, render_fn=None, max_pool=False):
+    r"""
+    Applies `action` up to `frame_skip` times, summing the rewards and stopping as soon as the episode is done.
+
+    If `render_fn` is given, the image after the last step is rendered with it. With `max_pool`, it is the max of the
+    images of the last two steps, which removes the flickering of Atari like envs. Envs that process their frames,
+    such as a `FramePipeline`, take the max of the raw frames with their `max_pool_next_render`.
+
+    Returns: The last observation, the summed reward, done, the last info, and the image.
+    """
+    total_reward, prev_image = 0., None
+    pool_fn = getattr(env, 'max_pool_next_render', None)
+    for i in range(frame_skip):
+        s_prime, reward, done, info = env.step(action)
+        total_reward += reward
+        if done or i == frame_skip - 1: break
+        if max_pool and render_fn is not None and i == frame_skip - 2:
+            if pool_fn is not None: pool_fn()
+            else: prev_image = render_fn(env)
+    image = None if render_fn is None else render_fn(env)
+    if prev_image is not None and image is not None: image = np.maximum(prev_image, image)
+    return s_prime, total_reward, done, info, image
+
+
+def _shared_memory():
+    r""" `multiprocessing.shared_memory` is only in Python 3.8 or newer, so it is imported when workers are made. """
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise ImportError('EnvWorkers needs multiprocessing.shared_memory, which is only in Python 3.8 or newer. Use '
+                          'env_workers=False on older Pythons.')
+    return shared_memory
+
+
+def _attach(specs):
+    r""" Attaches to the shared memory blocks in `specs`, returning the blocks and their arrays. """
+    shared_memory = _shared_memory()
+    blocks = {k: shared_memory.SharedMemory(name=name) for k, (name, _, _) in specs.items()}
+    return blocks, {k: np.ndarray(shape, dtype=dtype, buffer=blocks[k].buf) for k, (_, shape, dtype) in specs.items()}
+
+
+def _worker(env_fn, idx, conn, specs, frame_skip, max_pool):
+    r""" Steps a single env, writing its results into row `idx` of the shared arrays. """
+    env = env_fn()
+    blocks, arrays = _attach(specs)
+    try:
+        while True:
+            cmd, action, render = conn.recv()
+            if cmd == 'reset': obs, image = env.reset(), _image(env) if render else None
+            elif cmd == 'step':
+                obs, arrays['reward'][idx], arrays['done'][idx], _, image = \
+                    repeat_step(env, action, frame_skip, _image if render else None, max_pool)
+            else: break
+            arrays['obs'][idx] = _obs_array(obs, env.observation_space)
+            if image is not None and 'image' in arrays: arrays['image'][idx] = image
+            conn.send(None)
+    finally:
+        env.close()
+        # The arrays are views of the blocks, which can only be closed once they are gone.
+        arrays.clear()
+        for block in blocks.values(): block.close()
+        conn.close()
+
+
+class EnvWorkers(object):
+    def __init__(self, env_fn: Callable[[], gym.Env], n_envs, render_images=True, frame_skip=1, max_pool=False):
+        r"""
+        Runs `n_envs` envs in their own processes, which write their observations, rewards, dones, and images into
+        preallocated `multiprocessing.shared_memory` arrays.
+
+        Only the commands and actions go through pipes. Results are read from the shared arrays, so nothing is
+        pickled, and all the envs step in parallel.
+
+        An extra env is made in this process, and is never stepped. It is used for the spaces, the spec, and the
+        shapes of the shared arrays.
+
+        Args:
+            env_fn: Makes an env. Needs to be picklable if processes are not forked, such as a `partial` of a module
+                    level function.
+            n_envs: Number of envs, and so of worker processes.
+            render_images: Whether the workers render an image after every reset and step.
+            frame_skip: Number of times each action is repeated, see `repeat_step`.
+            max_pool: Whether the images are the max of the last two repeated steps.
+        """
+        shared_memory = _shared_memory()
+        self.n_envs, self.frame_skip = n_envs, frame_skip
+        self.env = env_fn()
+        obs = _obs_array(self.env.reset(), self.env.observation_space)
+        image = _image(self.env) if render_images else None
+
+        shapes = {'obs': (obs.shape, obs.dtype), 'reward': ((), np.float64), 'done': ((), np.bool_)}
+        if image is not None: shapes['image'] = (np.shape(image), np.asarray(image).dtype)
+        self.blocks, specs = {}, {}
+        for k, (shape, dtype) in shapes.items():
+            shape, dtype = (n_envs,) + tuple(shape), np.dtype(dtype)
+            self.blocks[k] = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+            specs[k] = (self.blocks[k].name, shape, dtype.str)
+        self.arrays = {k: np.ndarray(shape, dtype=dtype, buffer=self.blocks[k].buf)
+                       for k, (_, shape, dtype) in specs.items()}
+
+        ctx = get_context()
+        self.conns, self.processes = [], []
+        for i in range(n_envs):
+            conn, worker_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(env_fn, i, worker_conn, specs, frame_skip, max_pool),
+                                  daemon=True)
+            process.start()
+            worker_conn.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+        self.closed = False
+
+    @property
+    def observation_space(self): return self.env.observation_space
+    @property
+    def action_space(self): return self.env.action_space
+    @property
+    def spec(self): return self.env.spec
+
+    def _run(self, commands):
+        r""" Sends every (env index, command, action, render) in `commands`, then waits for all of them to be done. """
+        for i, cmd, action, render in commands: self.conns[i].send((cmd, action, render))
+        for i, _, _, _ in commands: self.conns[i].recv()
+
+    def _images(self, idx, render):
+        return [self.arrays['image'][i].copy() if r and 'image' in self.arrays else None for i, r in zip(idx, render)]
+
+    def reset(self, idx: List[int], render: List[bool] = None):
+        r"""
+        Resets the envs at `idx` in parallel, returning their observations and images. Only the envs whose `render`
+        is True render an image, the others return None. All of them render by default.
+        """
+        render = [True] * len(idx) if render is None else render
+        self._run([(i, 'reset', None, r) for i, r in zip(idx, render)])
+        return [self.arrays['obs'][i].copy() for i in idx], self._images(idx, render)
+
+    def step(self, actions, render: List[bool] = None):
+        r""" Steps every env with its action in parallel, returning the observations, rewards, dones, and images. """
+        idx, render = range(self.n_envs), [True] * self.n_envs if render is None else render
+        self._run([(i, 'step', action, r) for i, action, r in zip(idx, actions, render)])
+        return [self.arrays['obs'][i].copy() for i in idx], self.arrays['reward'].tolist(), \
+               self.arrays['done'].tolist(), self._images(idx, render)
+
+    def close(self):
+        if self.closed: return
+        for conn in self.conns:
+            try: conn.send(('close', None, False))
+            except (BrokenPipeError, EOFError): pass
+        for process in self.processes: process.join(timeout=5)
+        self.arrays.clear()
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.env.close()
+        self.closed = True
@@ -21,6 +21,7 @@ from matplotlib.figure import Figure
 from matplotlib.ticker import MaxNLocator
 
 from fast_rl.core.data_block import MDPList, FEED_TYPE_IMAGE
+from fast_rl.core.data_structures import CompressedFrame, decompress_frames
 
 
 def array_flatten(array):
@@ -68,7 +69,7 @@ def cumulate_squash(values: Union[list, List[list]], squash_episodes=False, cumu
 
 
 def group_by_episode(items: MDPList, episodes: list):
-    ils = [copy(items).filter_by_func(lambda x: x.episode in episodes and x.episode == ep) for ep in episodes]
+    ils = [items.new(items.filter_by_episode(ep)) for ep in episodes]
     return [il for il in ils if len(il.items) != 0]
 
 
@@ -172,7 +173,7 @@ class AgentInterpretation(Interpretation):
     def __init__(self, learn: Learner, ds_type: DatasetType = DatasetType.Valid, close_env=True):
         super().__init__(learn, None, None, None, ds_type=ds_type)
         self.groups = []
-        if close_env: self.ds.env.close()
+        if close_env: self.ds.close()
 
     def get_values(self, il: MDPList, value_name, per_episode=False):
         if per_episode:
@@ -208,9 +209,14 @@ class AgentInterpretation(Interpretation):
         return interp
 
     def frames(self, items):
-        return [
-            _.s.detach().cpu().numpy() if self.ds.feed_type == FEED_TYPE_IMAGE else _.alt_s_prime.detach().cpu().numpy()
-            for _ in items]
+        frames = [_.state.s if self.ds.feed_type == FEED_TYPE_IMAGE else _.state.alt_s_prime for _ in items]
+        # Compressed frames are decompressed all at once instead of one by one.
+        compressed = [i for i, frame in enumerate(frames) if isinstance(frame, CompressedFrame)]
+        if compressed:
+            for i, frame in zip(compressed, decompress_frames([frames[i] for i in compressed])): frames[i] = frame
+        # Steps that the render policy skipped have no frame.
+        return [frame if isinstance(frame, np.ndarray) else frame.detach().cpu().numpy() for frame in frames
+                if frame is not None]
 
     def generate_gif(self, episode: Union[None, list, int] = None) -> Union[Gif, List[Gif]]:
         full_episodes = list(set([k for k in self.ds.x.info if not self.ds.x.info[k][1]]) - {-1})
@@ -384,7 +390,7 @@ class QValueInterpretation(AgentInterpretation):
 
     def q(self, items):
         actual, predicted = [], []
-        episode_partition = [[i for i in items.items if i.episode == key] for key in items.info]
+        episode_partition = [items.filter_by_episode(key) for key in items.info]
 
         for ei in episode_partition:
             if not ei: continue
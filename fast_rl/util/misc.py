@@ -1,4 +1,5 @@
 import gym
+import numpy as np
 from gym import error
 
 
@@ -33,3 +34,17 @@ def is_goal_env(env, suppress_errors=True):
             else:
                 return False
     return True
+
+
+def dict_obs_slices(observation_space: gym.spaces.Dict):
+    r""" Returns the slice of each key of a `gym.spaces.Dict` observation in its flattened version. """
+    slices, start = {}, 0
+    for key, space in observation_space.spaces.items():
+        slices[key] = slice(start, start + int(np.prod(space.shape)))
+        start = slices[key].stop
+    return slices
+
+
+def flatten_dict_obs(obs: dict, observation_space: gym.spaces.Dict):
+    r""" Concatenates the values of a `gym.spaces.Dict` observation in the order of `observation_space`. """
+    return np.concatenate([np.asarray(obs[key], dtype=float).reshape(-1) for key in observation_space.spaces])
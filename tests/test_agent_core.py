@@ -6,3 +6,122 @@
 # from fast_rl.core.basic_train import AgentLearner
 #
 
+import pickle
+from itertools import product
+from threading import Thread
+
+import numpy as np
+import pytest
+import torch
+
+from fast_rl.agents.dqn import create_dqn_model, dqn_learner
+from fast_rl.agents.dqn_models import DQNModule
+from fast_rl.core.agent_core import Experience, ExperienceReplay, PriorityExperienceReplay, GreedyEpsilon, \
+    RankPriorityExperienceReplay, ShardedExperienceReplay, PrefetchExperienceReplay, SequenceExperienceReplay, \
+    OrnsteinUhlenbeck
+from fast_rl.core.data_block import MDPDataBunch, MDPBatch
+
+
+@pytest.mark.parametrize(["memory_cls", "storage"],
+                         list(product([ExperienceReplay, PriorityExperienceReplay, RankPriorityExperienceReplay],
+                                      ['arrays', 'memmap'])))
+def test_array_storage(memory_cls, storage):
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop)
+    memory = memory_cls(memory_size=1000, storage=storage)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(2)
+
+    batch = memory.sample(5)
+    assert isinstance(batch, MDPBatch)
+    assert batch.s.shape == batch.s_prime.shape == (5, 4)
+    assert batch.a.shape == batch.reward.shape == batch.done.shape == (5, 1)
+
+
+@pytest.mark.parametrize("memory_cls", [ExperienceReplay, PriorityExperienceReplay])
+def test_n_step(memory_cls):
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop)
+    memory = memory_cls(memory_size=1000, storage='arrays', n_step=3, gamma=model.discount)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(2)
+
+    batch = memory.sample(5)
+    assert batch.discount.shape == batch.reward.shape == (5, 1)
+    assert torch.all(batch.discount <= model.discount)
+
+
+@pytest.mark.parametrize("memory_fn", [ExperienceReplay, PriorityExperienceReplay])
+def test_sharded_replay(memory_fn, tmp_path):
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop)
+    memory = ShardedExperienceReplay(memory_size=1000, n_shards=2, memory_fn=memory_fn, storage='arrays')
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(2)
+    # The learner is a single producer, which moves to the next shard after every episode.
+    assert all(len(shard) != 0 for shard in memory.shards)
+
+    n_items = len(memory)
+    producers = [Thread(target=lambda: [memory.update(item) for item in data.x.items]) for _ in range(2)]
+    for producer in producers: producer.start()
+    batches = [memory.sample(5) for _ in range(10)]
+    for producer in producers: producer.join()
+
+    assert len(memory) == n_items + 2 * len(data.x.items)
+    assert all(isinstance(batch, MDPBatch) and len(batch) == 5 for batch in batches)
+    if memory_fn is PriorityExperienceReplay:
+        # The IS weights are normalized over the whole memory, so no shard's weights exceed 1.
+        memory.sample(5)
+        assert len(memory.p_weights) == 5 and np.all(memory.p_weights <= 1 + 1e-6)
+
+    assert len(pickle.loads(pickle.dumps(memory))) == len(memory)
+    memory.save(tmp_path)
+    loaded = Experience.load(tmp_path)
+    assert isinstance(loaded, ShardedExperienceReplay) and len(loaded) == len(memory)
+    assert isinstance(loaded.sample(5), MDPBatch)
+
+
+@pytest.mark.parametrize(["memory_cls", "storage"], list(product([ExperienceReplay, PriorityExperienceReplay],
+                                                                 ['objects', 'arrays'])))
+def test_prefetch_replay(memory_cls, storage):
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop)
+    memory = PrefetchExperienceReplay(memory_cls(memory_size=1000, storage=storage))
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(2)
+
+    batch = memory.sample(5)
+    assert isinstance(batch, MDPBatch) and len(batch) == 5
+    if memory_cls is PriorityExperienceReplay:
+        assert len(memory._state['_indices']) == len(memory.p_weights) == 5
+
+
+def test_sequence_replay():
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=ExperienceReplay(memory_size=1000),
+                          exploration_method=exploration_method)
+    learner.fit(2)
+
+    memory = SequenceExperienceReplay(memory_size=1000, seq_len=4)
+    for item in data.x.items: memory.update(item)
+    batch = memory.sample(5)
+    assert batch.s.shape == (5, 4, 4) and batch.mask.shape == (5, 4)
+    assert torch.all(batch.mask[:, 0])
+
+    # Other memories cannot sample the extra columns of the storage, and windows are not n-step rewards.
+    with pytest.raises(ValueError): ExperienceReplay(memory_size=1000, storage='sequences')
+    with pytest.raises(ValueError): SequenceExperienceReplay(memory_size=1000, n_step=3)
+
+
+def test_ornstein_uhlenbeck_per_env():
+    exploration_method = OrnsteinUhlenbeck(size=(1, 2), epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    actions = exploration_method.perturb(np.zeros((3, 2)), None)
+    # Every env has its own noise state.
+    assert exploration_method.x.shape == actions.shape == (3, 2)
+    assert len({tuple(action) for action in actions}) == 3
@@ -2,9 +2,9 @@ import os
 
 
 
-from fast_rl.agents.dqn import create_dqn_model, FixedTargetDQNModule, dqn_learner
-from fast_rl.core.agent_core import ExperienceReplay, torch, GreedyEpsilon
-from fast_rl.core.basic_train import load_learner
+from fast_rl.agents.dqn import create_dqn_model, DQNModule, FixedTargetDQNModule, dqn_learner
+from fast_rl.core.agent_core import ExperienceReplay, torch, GreedyEpsilon, PriorityExperienceReplay
+from fast_rl.core.basic_train import load_learner, ExperimentRunner
 from fast_rl.core.data_block import MDPDataBunch
 
 
@@ -63,3 +63,40 @@ def test_export_learner():
 	learner.export('test_export.pkl')#, pickle_data=True)
 	learner = load_learner(learner.path, 'test_export.pkl')
 	learner.fit(2)
+
+
+def test_export_learner_binary_memory():
+	data=MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False)
+	model=create_dqn_model(data, FixedTargetDQNModule, opt=torch.optim.RMSprop)
+	memory=PriorityExperienceReplay(memory_size=1000, storage='arrays')
+	exploration_method=GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+	learner=dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+	learner.fit(2)
+
+	learner.export('test_export_binary.pkl', memory_dir='test_export_memory')
+	learner=load_learner(learner.path, 'test_export_binary.pkl')
+	assert len(learner.memory)==len(memory)
+	assert learner.memory.tree.total()==memory.tree.total()
+	learner.fit(2)
+
+
+def _runner_learner(model_cls, seed):
+	data=MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False, make_dir=False)
+	data.train_ds.env.seed(seed)
+	model=create_dqn_model(data, model_cls, opt=torch.optim.RMSprop)
+	memory=ExperienceReplay(memory_size=1000, reduce_ram=True)
+	exploration_method=GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+	return dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+
+
+def test_experiment_runner():
+	streamed=[]
+	runner=ExperimentRunner(_runner_learner, n_workers=2)
+	group_interp=runner.start({'dqn': DQNModule, 'fixed_target': FixedTargetDQNModule}, seeds=[0, 1], epochs=2,
+							  on_reward=lambda *args: streamed.append(args))
+
+	assert len(group_interp.groups)==4
+	assert {g.meta for g in group_interp.groups}=={'dqn', 'fixed_target'}
+	assert set(runner.epoch_rewards)=={(name, seed) for name in ('dqn', 'fixed_target') for seed in (0, 1)}
+	assert all(len(rewards)==2 for rewards in runner.epoch_rewards.values())
+	assert len(streamed)==8
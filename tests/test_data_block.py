@@ -1,4 +1,6 @@
 import os
+import pickle
+import sys
 from functools import partial
 from itertools import product
 
@@ -11,7 +13,9 @@ from fastai.basic_train import ItemLists
 from fast_rl.agents.dqn import create_dqn_model, dqn_learner
 from fast_rl.agents.dqn_models import DQNModule
 from fast_rl.core.agent_core import GreedyEpsilon, ExperienceReplay
-from fast_rl.core.data_block import MDPDataBunch, ResolutionWrapper, FEED_TYPE_IMAGE
+from fast_rl.core.data_block import MDPDataBunch, ResolutionWrapper, FEED_TYPE_IMAGE, FramePipeline, MDPStep, \
+    Action, State, space_meta
+from fast_rl.core.env_workers import repeat_step
 from fast_rl.core.metrics import RewardMetric, EpsilonMetric
 
 
@@ -70,3 +74,217 @@ def test_resolution_wrapper():
     temp.reset()
     original_shape = temp.render(mode='rgb_array').shape
     assert data.env.render(mode='rgb_array').shape == (original_shape[0] // 2, original_shape[1] // 2, 3)
+
+
+def test_vector_envs():
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False, n_envs=4)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop, lr=0.1)
+    memory = ExperienceReplay(memory_size=1000, reduce_ram=True)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(2)
+
+    items = data.train_ds.x.items
+    assert len(items) % 4 == 0 and len(memory) == len(items)
+    for episode in data.train_ds.x.info:
+        steps = [item.step for item in items if item.episode == episode]
+        assert steps == list(range(steps[0], steps[0] + len(steps)))
+        assert np.isclose(data.train_ds.x.info[episode][0], sum(float(item.reward) for item in items
+                                                                if item.episode == episode))
+
+    # The steps of the envs are interleaved, which n-step returns cannot handle.
+    with pytest.raises(ValueError):
+        dqn_learner(data=data, model=model, memory=ExperienceReplay(memory_size=1000, storage='arrays', n_step=3),
+                    exploration_method=exploration_method)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason='EnvWorkers needs multiprocessing.shared_memory')
+def test_env_workers():
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False, n_envs=3,
+                                 env_workers=True)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop, lr=0.1)
+    memory = ExperienceReplay(memory_size=1000, reduce_ram=True)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(2)
+
+    items = data.train_ds.x.items
+    assert len(items) % 3 == 0 and len(memory) == len(items)
+    for i in range(1, len(items) // 3):
+        for prev, item in zip(items[(i - 1) * 3:i * 3], items[i * 3:(i + 1) * 3]):
+            if not prev.d: assert torch.equal(prev.state.s_prime, item.state.s)
+    data.close()
+    assert data.train_ds.workers.closed
+
+
+@pytest.mark.parametrize("policy_lag", [0, 1])
+def test_async_step(policy_lag):
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False,
+                                 async_step=True, policy_lag=policy_lag)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop, lr=0.1)
+    memory = ExperienceReplay(memory_size=1000, reduce_ram=True)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(3)
+
+    items = data.train_ds.x.items
+    assert len(memory) == len(items)
+    for prev, item in zip(items[:-1], items[1:]):
+        if not prev.d: assert torch.equal(prev.state.s_prime, item.state.s)
+    # Steps made in the last batch of an epoch get the episode number of the next one.
+    assert [item.episode for item in items] == sorted(item.episode for item in items)
+    data.close()
+
+
+@pytest.mark.parametrize("render_policy", ['never', 2, 'k_top'])
+def test_render_policy(render_policy):
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False,
+                                 render_policy=render_policy, memory_management_strategy='k_top', k=2)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop, lr=0.1)
+    memory = ExperienceReplay(memory_size=1000, reduce_ram=True)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(3)
+
+    # The memory manager removes the images of the episodes it does not keep.
+    items = [item for item in data.train_ds.x.items if not data.train_ds.x.info[item.episode][1]]
+    if render_policy == 'never': assert all(item.state.alt_s_prime is None for item in items)
+    elif render_policy == 2:
+        assert all((item.state.alt_s_prime is not None) == ((item.step + 1) % 2 == 0) for item in items)
+    else: assert all(item.state.alt_s_prime is not None for item in items)
+
+    if render_policy == 'k_top':
+        # CartPole has an unbounded reward range, so with a bounded one an episode that cannot reach the top k is
+        # not rendered.
+        ds = data.train_ds
+        ds.env.reward_range = (0., 1.)
+        ds._running_rewards[0], ds._top_rewards = 0., [ds.max_steps + 2.] * ds.k
+        assert not ds._needs_image(0, 0)
+        ds._top_rewards = [ds.max_steps + 1.] * ds.k
+        assert ds._needs_image(0, 0)
+
+
+def test_frame_pipeline():
+    env = FramePipeline(gym.make('CartPole-v0'), crop=(100, 300, None, None), stride=(2, 2), resize=(50, 60),
+                        grayscale=True, channel_first=True, n_frames=3)
+    env.reset()
+    first = env.render('rgb_array')
+    assert first.shape == (3, 50, 60) and first.dtype == np.uint8
+    assert all(np.array_equal(first[0], first[i]) for i in range(3))
+    env.step(0)
+    second = env.render('rgb_array')
+    assert np.array_equal(second[1], first[2]) and np.array_equal(second[2], env.render('rgb_array')[2])
+
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=10, add_valid=False,
+                                 feed_type=FEED_TYPE_IMAGE, res_wrap=partial(FramePipeline, stride=(4, 4),
+                                                                             grayscale=True, channel_first=True,
+                                                                             n_frames=4))
+    assert data.state.s.shape[1] == 4
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop, lr=0.1, channels=[16, 16], ks=[5, 5],
+                             stride=[2, 2])
+    memory = ExperienceReplay(memory_size=1000, reduce_ram=True)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(2)
+    assert not model.switched
+
+
+def test_frame_skip():
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False, frame_skip=4)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop, lr=0.1)
+    memory = ExperienceReplay(memory_size=1000, reduce_ram=True)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(2)
+
+    items = data.train_ds.x.items
+    # CartPole gives a reward of 1 per step, so every action that did not end the episode was repeated 4 times.
+    assert all(float(item.reward) == 4 for item in items if not item.d)
+    assert all(1 <= float(item.reward) <= 4 for item in items)
+
+
+def test_frame_skip_frame_stack():
+    env = FramePipeline(gym.make('CartPole-v0'), stride=(4, 4), grayscale=True, channel_first=True, n_frames=3)
+    reference = gym.make('CartPole-v0')
+    for e in (env, reference):
+        e.seed(0)
+        e.reset()
+    first = env.render('rgb_array')
+    image = repeat_step(env, 0, frame_skip=2, render_fn=lambda e: e.render('rgb_array'), max_pool=True)[-1]
+
+    raw = []
+    for _ in range(2):
+        reference.step(0)
+        raw.append(reference.render('rgb_array'))
+    # One frame is pushed per decision, and it is the processed max of the raw frames of the last two steps.
+    assert np.array_equal(image[:2], first[1:]) and np.array_equal(image[2], env.process(np.maximum(*raw))[0])
+
+
+def test_mdp_step_copy():
+    env = gym.make('CartPole-v0')
+    s = env.reset()
+    s_prime = env.step(0)[0]
+    state = State(s, s_prime, np.zeros((4, 4, 3)), np.ones((4, 4, 3)), env.observation_space)
+    item = MDPStep(Action(taken_action=0, action_space=env.action_space), state, False, 1., 0, 0)
+    assert not hasattr(item, '__dict__')
+
+    copied = item.copy()
+    copied.clean()
+    assert copied.s is item.s and copied.alt_s_prime is None and item.alt_s_prime is not None
+    assert item.state.bounds is item.state_bounds and item.action.get_single_action() == 0
+
+    loaded = pickle.loads(pickle.dumps(item))
+    assert torch.equal(loaded.s_prime, item.s_prime) and loaded.episode == item.episode
+
+
+def test_space_meta():
+    env = gym.make('CartPole-v0')
+    s = env.reset()
+    states = [State(s, s, None, None, env.observation_space) for _ in range(2)]
+    assert states[0].bounds is states[1].bounds is space_meta(env.observation_space).bounds
+    assert Action(taken_action=1, action_space=env.action_space).bounds is space_meta(env.action_space).bounds
+    assert torch.equal(states[0].s, torch.from_numpy(s).float().reshape(1, -1))
+
+    image = np.zeros((8, 8, 3))
+    images = [State(s, s, image, image, env.observation_space, FEED_TYPE_IMAGE) for _ in range(2)]
+    assert images[0].observation_space is images[1].observation_space and images[0].s.shape == (1, 8, 8, 3)
+
+
+def test_state_zero_copy():
+    space = gym.spaces.Box(-1, 1, (3,), dtype=np.float32)
+    s, s_prime = np.zeros(3, dtype=np.float32), np.ones(3)
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    state = State(s, s_prime, image, image, space)
+    assert np.shares_memory(state.s.numpy(), s) and state.s.dtype == torch.float32
+    assert state.s_prime.dtype == torch.float32 and torch.equal(state.s_prime, torch.ones(1, 3))
+    assert state.alt_s.dtype == torch.uint8 and state.alt_s.shape == (1, 8, 8, 3)
+
+    images = State(s, s_prime, image, image, space, FEED_TYPE_IMAGE)
+    assert images.s.dtype == torch.uint8 and images.s_prime.dtype == torch.uint8
+
+    # A strided view, such as from the ResolutionWrapper, is copied instead of keeping the whole image alive.
+    full = np.zeros((60, 40, 3), dtype=np.uint8)
+    strided = State(s, s_prime, full[::2, ::2], full[::2, ::2], space, FEED_TYPE_IMAGE)
+    assert not np.shares_memory(strided.s.numpy(), full) and strided.s.shape == (1, 30, 20, 3)
+
+
+def test_mdp_list_episode_index():
+    data = MDPDataBunch.from_env('CartPole-v0', render='rgb_array', bs=5, max_steps=20, add_valid=False,
+                                 memory_management_strategy='k_top', k=3)
+    model = create_dqn_model(data, DQNModule, opt=torch.optim.RMSprop, lr=0.1)
+    memory = ExperienceReplay(memory_size=1000, reduce_ram=True)
+    exploration_method = GreedyEpsilon(epsilon_start=1, epsilon_end=0.1, decay=0.001)
+    learner = dqn_learner(data=data, model=model, memory=memory, exploration_method=exploration_method)
+    learner.fit(5)
+
+    items = data.train_ds.x
+    episodes = {item.episode for item in items.items}
+    assert set(items.episodes) == episodes
+    for episode in episodes:
+        scanned = [item for item in items.items if item.episode == episode]
+        assert all(a is b for a, b in zip(items.filter_by_episode(episode), scanned))
+        assert len(items.filter_by_episode(episode)) == len(scanned)
+        assert np.isclose(items.episode_rewards[episode], sum(float(item.reward) for item in scanned))
+
+    loaded = pickle.loads(pickle.dumps(items))
+    assert {k: len(v) for k, v in loaded.episodes.items()} == {k: len(v) for k, v in items.episodes.items()}
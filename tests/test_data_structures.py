@@ -1,4 +1,8 @@
-from fast_rl.core.data_structures import print_tree, SumTree
+import numpy as np
+
+from fast_rl.core.data_structures import print_tree, SumTree, ArrayBuffer, MemMapBuffer, FrameBuffer, NStepReturns, \
+    RankHeap, CompressedBuffer, CompressedFrame, save_state, load_state, SequenceBuffer, \
+    HindsightBuffer
 
 
 def test_sum_tree_with_max_size():
@@ -13,3 +17,236 @@ def test_sum_tree_with_max_size():
     print_tree(memory)
 
 
+def test_sum_tree_batch_get_matches_get():
+    memory = SumTree(10)
+
+    values = [1, 2, 3, 4, 5, 6]
+    for i, value in enumerate(values):
+        memory.add(value, f'data {i}')
+
+    ss = np.linspace(0, memory.total(), num=25)[1:-1]
+    idx, priorities, data = memory.batch_get(ss)
+    assert len(idx) == len(ss)
+    for s, i, p, d in zip(ss, idx, priorities, data):
+        assert (i, p, d) == memory.get(s)
+
+
+def test_sum_tree_batch_get_ignores_empty_leaves():
+    memory = SumTree(8)
+    memory.add(1, 'data')
+
+    idx, priorities, data = memory.batch_get([0, 0.5, 1, 5])
+    assert len(idx) == 3
+    assert all(d == 'data' for d in data)
+
+
+def test_sum_tree_batch_update():
+    memory = SumTree(10)
+    for i in range(10):
+        memory.add(1, f'data {i}')
+
+    # Siblings and duplicates in the same update. The last duplicate priority wins.
+    memory.update(np.array([9, 10, 10, 17, 18]), np.array([2., 3., 4., 5., 6.]))
+
+    leaves = memory.tree[memory.capacity - 1:]
+    assert memory.tree[10] == 4
+    assert memory.total() == np.sum(leaves) == 23
+    for i in reversed(range(memory.capacity - 1)):
+        assert memory.tree[i] == memory.tree[memory.get_left(i)] + memory.tree[memory.get_right(i)]
+
+
+def test_array_buffer_ring():
+    memory = ArrayBuffer(4)
+    for i in range(6):
+        assert memory.add(s=np.full(3, i, dtype=np.float32), done=np.array([i % 2])) == i % 4
+
+    assert len(memory) == 4 and memory.write == 2
+    assert memory.columns['s'].shape == (4, 3) and memory.columns['s'].dtype == np.float32
+    np.testing.assert_array_equal(memory.get(np.array([0, 1, 2]))['s'][:, 0], [4, 5, 2])
+
+    assert memory.sample(3)['s'].shape == (3, 3)
+    assert memory.sample(8)['done'].shape == (4, 1)
+
+
+def test_sum_tree_min_max():
+    memory = SumTree(5)
+    for value in [3, 1, 4, 1, 5, 9, 2]:
+        memory.add(value, 'data')
+
+    # The first 2 values were overwritten by the ring.
+    assert memory.min() == 1 and memory.max() == 9
+    memory.update(np.array([5, 4]), np.array([0.5, 6.]))
+    assert memory.min() == 0.5 and memory.max() == 6
+
+    weights = memory.anneal_weights(np.array([6., 0.5]), beta=1)
+    assert weights[1] == 1 and weights[0] < 1
+
+
+def test_mem_map_buffer(tmp_path):
+    memory = MemMapBuffer(4, path=str(tmp_path / 'replay.dat'))
+    for i in range(5):
+        memory.add(s=np.full((2, 2, 3), i, dtype=np.uint8), s_prime=np.full((2, 2, 3), i + 1, dtype=np.uint8),
+                   reward=np.array([i], dtype=np.float32))
+
+    assert isinstance(memory.columns['s'], np.memmap) and not isinstance(memory.columns['reward'], np.memmap)
+    batch = memory.get(np.array([0, 3]))
+    np.testing.assert_array_equal(batch['s'][:, 0, 0, 0], [4, 3])
+    np.testing.assert_array_equal(batch['s_prime'][:, 0, 0, 0], [5, 4])
+    assert batch['s'].shape == (2, 2, 2, 3)
+
+    memory.flush()
+    records = np.memmap(str(tmp_path / 'replay.dat'), dtype=memory.records.dtype, mode='r', shape=(4,))
+    np.testing.assert_array_equal(records['s'][1], memory.columns['s'][1])
+
+
+def test_frame_buffer_stores_frames_once():
+    memory = FrameBuffer(10)
+    # 2 episodes of 3 steps, where the first state of each episode comes from a reset.
+    for episode in range(2):
+        for step in range(3):
+            s = np.full(2, episode * 10 + step, dtype=np.float32)
+            memory.add(s=s, s_prime=s + 1, done=np.array([step == 2]))
+
+    assert len(memory) == 6 and memory.frames_written == 8
+    batch = memory.get(np.arange(6))
+    np.testing.assert_array_equal(batch['s'][:, 0], [0, 1, 2, 10, 11, 12])
+    np.testing.assert_array_equal(batch['s_prime'][:, 0], [1, 2, 3, 11, 12, 13])
+
+
+def test_frame_buffer_drops_transitions_without_frames():
+    memory = FrameBuffer(4, n_frames=5)
+    # Every transition is its own episode, so each one needs 2 frames.
+    for i in range(4):
+        memory.add(s=np.array([i * 10]), s_prime=np.array([i * 10 + 1]))
+
+    assert len(memory) == 2
+    np.testing.assert_array_equal(memory.is_valid(np.arange(4)), [False, False, True, True])
+    batch = memory.sample(8)
+    np.testing.assert_array_equal(batch['s'][:, 0], [20, 30])
+    np.testing.assert_array_equal(batch['s_prime'][:, 0], [21, 31])
+
+
+def test_compressed_buffer():
+    memory = CompressedBuffer(4, n_workers=2)
+    frames = [np.random.randint(0, 3, size=(1, 8, 8, 3)).astype(np.float32) for _ in range(5)]
+    for i in range(4):
+        memory.add(s=frames[i], s_prime=frames[i + 1], a=np.array([i]))
+
+    assert isinstance(memory.columns['s'][0], CompressedFrame)
+    batch = memory.get(np.array([2, 0]))
+    assert batch['s'].shape == (2, 1, 8, 8, 3) and batch['s'].dtype == np.float32
+    np.testing.assert_array_equal(batch['s'], np.stack([frames[2], frames[0]]))
+    np.testing.assert_array_equal(batch['s_prime'][1], frames[1])
+    np.testing.assert_array_equal(batch['a'][:, 0], [2, 0])
+
+
+def test_n_step_returns():
+    returns = NStepReturns(8, n_step=3, gamma=0.5)
+    rewards, dones = [1, 2, 4, 8, 16, 32], [0, 0, 0, 0, 1, 0]
+    for idx, (r, d) in enumerate(zip(rewards, dones)): returns.add(idx, np.array([r]), np.array([d]))
+
+    reward, discount, bootstrap = returns.get(np.arange(6))
+    np.testing.assert_array_almost_equal(reward[:, 0], [1 + 1 + 1, 2 + 2 + 2, 4 + 4 + 4, 8 + 8, 16, 32])
+    np.testing.assert_array_almost_equal(discount[:, 0], [0.125, 0.125, 0, 0, 0, 0.5])
+    np.testing.assert_array_equal(bootstrap, [2, 3, 4, 4, 4, 5])
+
+
+def test_buffer_get_keys():
+    memory = FrameBuffer(4)
+    for i in range(3): memory.add(s=np.full(2, i), s_prime=np.full(2, i + 1), reward=np.array([i]))
+    fields = memory.get(np.array([2, 0]), keys=('s_prime', 'reward'))
+    assert set(fields) == {'s_prime', 'reward'}
+    np.testing.assert_array_equal(fields['s_prime'][:, 0], [3, 1])
+
+
+def test_rank_heap():
+    heap = RankHeap(8, alpha=1., sort_every=4, n_partitions=8)
+    for i in range(8): heap.add(i, i)
+    assert heap.max() == 7 and heap.data[heap.heap[0]] == 7
+
+    heap.update(np.array([0, 7]), np.array([10, -1]))
+    assert heap.data[heap.heap[0]] == 0
+    heap.add(3.5, 'new')  # Overwrites data index 0
+    heap.update(np.array([1, 2]), np.array([1, 2]))
+    np.testing.assert_array_equal(heap.priorities, [6, 5, 4, 3.5, 3, 2, 1, -1])
+    np.testing.assert_array_equal(heap.heap, [6, 5, 4, 0, 3, 2, 1, 7])
+
+    idx, probabilities, data = heap.sample(4)
+    assert len(idx) == 4 and idx[0] == 6
+    np.testing.assert_array_almost_equal(probabilities, 1 / (heap.positions[idx] + 1) / np.sum(1 / np.arange(1, 9)))
+    assert heap.anneal_weights(probabilities, 1.).max() <= 1
+
+
+def is_heap(heap):
+    priorities, children = heap.priorities[:heap.n_entries], np.arange(1, heap.n_entries)
+    return np.all(priorities[(children - 1) // 2] >= priorities[children]) and \
+        np.all(heap.positions[heap.heap[:heap.n_entries]] == np.arange(heap.n_entries))
+
+
+def test_rank_heap_batched():
+    heap = RankHeap(64, sort_every=10 ** 6)
+    for i in range(64): heap.add(np.random.rand(), i)
+    for _ in range(20):
+        heap.update(np.random.randint(0, 64, 32), np.random.rand(32) * 10 ** np.random.randint(-2, 3))
+        assert is_heap(heap)
+
+    heap.remove(np.array([3, 3, 10, 63]))
+    assert heap.n_entries == 61 and is_heap(heap)
+    assert np.all(heap.positions[[3, 10, 63]] == -1) and not np.isin([3, 10, 63], heap.heap[:heap.n_entries]).any()
+    heap.write = 10
+    heap.add(100., 'new')
+    assert heap.n_entries == 62 and heap.data[heap.heap[0]] == 'new' and is_heap(heap)
+
+
+def test_save_load_state(tmp_path):
+    tree, memory, frames = SumTree(8), FrameBuffer(4), CompressedBuffer(4, n_workers=1)
+    for i in range(6):
+        tree.add(i + 1, memory.add(s=np.full(2, i), s_prime=np.full(2, i + 1), reward=np.array([i])))
+        frames.add(s=np.full((4, 4), i, dtype=np.uint8), s_prime=np.full((4, 4), i + 1, dtype=np.uint8))
+    frames.columns['s'][3] = None
+
+    save_state({'tree': tree, 'memory': memory, 'frames': frames}, tmp_path)
+    loaded = load_state(tmp_path)
+    assert isinstance(loaded['memory'].columns['reward'], np.memmap)
+    assert loaded['tree'].total() == tree.total() and loaded['tree'].write == tree.write
+    assert loaded['tree'].min() == tree.min()
+    np.testing.assert_array_equal(loaded['tree'].batch_get(np.array([10.]))[2], tree.batch_get(np.array([10.]))[2])
+    np.testing.assert_array_equal(loaded['memory'].get(np.array([0, 1]))['s'], memory.get(np.array([0, 1]))['s'])
+    np.testing.assert_array_equal(loaded['frames'].get(np.array([2]))['s'], frames.get(np.array([2]))['s'])
+    assert loaded['frames'].columns['s'][3] is None
+
+    loaded['memory'].add(s=np.full(2, 9), s_prime=np.full(2, 9), reward=np.array([9]))
+    np.testing.assert_array_equal(load_state(tmp_path)['memory'].frames, memory.frames)
+
+
+def test_sequence_buffer():
+    memory = SequenceBuffer(6, seq_len=3)
+    dones = [0, 0, 1, 0, 0, 0, 0, 1]
+    for i, d in enumerate(dones): memory.add(s=np.full((2, 2), i + 1), done=np.array([d]))
+
+    # Rows now hold steps [6, 7, 2, 3, 4, 5]. Steps 3 to 7 are one episode.
+    windows = memory.get_windows(np.array([2, 4, 1]))
+    assert windows['s'].shape == (3, 3, 2, 2)
+    np.testing.assert_array_equal(windows['mask'], [[1, 0, 0], [1, 1, 1], [1, 0, 0]])
+    np.testing.assert_array_equal(windows['s'][:, :, 0, 0], [[3, 0, 0], [5, 6, 7], [8, 0, 0]])
+
+
+def test_hindsight_buffer():
+    # Flattened observations are [achieved_goal, desired_goal], with a reward of 0 when they match, else -1.
+    def compute_reward(achieved_goal, desired_goal, info):
+        return -(np.abs(achieved_goal - desired_goal).sum(axis=-1) > 0).astype(float)
+
+    memory = HindsightBuffer(16, slice(0, 1), slice(1, 2), compute_reward, k_future=np.inf)
+    for i in range(10): memory.add(s=np.array([i, 100.]), s_prime=np.array([i + 1, 100.]), reward=np.array([-1.]),
+                                   done=np.array([i == 4]))
+
+    fields = memory.relabel(np.arange(10))
+    achieved, goals = fields['s_prime'][:, 0], fields['s_prime'][:, 1]
+    np.testing.assert_array_equal(fields['s'][:, 1], goals)
+    # Goals come from the same episode, and are not in the past.
+    assert np.all(goals >= achieved) and np.all(goals[:5] <= 5) and np.all(goals[5:] > 5)
+    np.testing.assert_array_equal(fields['reward'][:, 0], -(goals != achieved).astype(float))
+    assert memory.vectorized
+
+    memory.compute_reward = lambda ag, g, info: float(compute_reward(np.asarray(ag), np.asarray(g), info))
+    assert memory.relabel(np.arange(10))['reward'].shape == (10, 1) and not memory.vectorized